@@ -1,9 +1,8 @@
-from flask import Flask, request, jsonify, render_template_string, send_from_directory
+from flask import Flask, Request, request, jsonify, render_template_string, send_from_directory, Response, stream_with_context, make_response, has_request_context
 from flask_cors import CORS
 from facebook import GraphAPI
 import os
 from dotenv import load_dotenv
-import openai
 from datetime import datetime, timedelta
 import re
 import json
@@ -12,9 +11,25 @@ import hmac
 import hashlib
 import logging
 from logging import StreamHandler
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
 from bson import ObjectId
 from functools import wraps
+from order_parser import parse_order_message
+from cache import LRUCache
+from llm_client import LLMBusyError, LLMClient
+from circuit_breaker import CircuitBreaker
+from image_variants import VARIANTS, variant_url
+from image_store import STORE_SUBDIR, HashingFile, ImageFetcher, ImageTooLarge, sniff_image_type, store_image_file, stored_image_digest
+from werkzeug.exceptions import RequestEntityTooLarge
+from order_events import BROADCAST, OrderEventBus, serialize_order, start_change_stream_watcher
+import queue
+import csv
+import io
+import zlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 load_dotenv()
 
@@ -25,13 +40,153 @@ FB_REDIRECT_URI = os.getenv('FB_REDIRECT_URI')
 META_VERIFY_TOKEN = os.getenv('META_VERIFY_TOKEN')
 PAGE_ACCESS_TOKEN = os.getenv('PAGE_ACCESS_TOKEN')
 MONGO_URI = os.getenv('MONGO_URI')
+# Multi-document transactions require MongoDB to run as a replica set
+MONGO_TRANSACTIONS_ENABLED = os.getenv('MONGO_TRANSACTIONS_ENABLED', 'false').lower() == 'true'
+
+# Webhook queue configuration
+WEBHOOK_QUEUE_ENABLED = os.getenv('WEBHOOK_QUEUE_ENABLED', 'false').lower() == 'true'
+# /api/health reports unhealthy when no webhook_worker.py heartbeat is newer than this
+WORKER_HEARTBEAT_TIMEOUT = int(os.getenv('WORKER_HEARTBEAT_TIMEOUT', 120))  # seconds
+
+# Local order parser configuration (messages below this confidence go to the LLM)
+ORDER_PARSER_MIN_CONFIDENCE = float(os.getenv('ORDER_PARSER_MIN_CONFIDENCE', 0.9))
+
+# LLM parsing configuration; bump PROMPT_VERSION whenever the prompt or schema changes so cached parses are not reused.
+# The model must support structured outputs (JSON schema response format).
+LLM_MODEL = os.getenv('LLM_MODEL', 'gpt-4o-mini')
+PROMPT_VERSION = "v2"
+LLM_MAX_COMPLETION_TOKENS = int(os.getenv('LLM_MAX_COMPLETION_TOKENS', 4096))
+ORDER_PARSE_INSTRUCTIONS = (
+    "Extract the orders from a single-line message. Format: product name, then for each customer "
+    "one or more \"<quantity> <color>\" items followed by \"(customer name)\". "
+    "Keep names and colors as written; use null when an item has no color."
+)
+ORDER_PARSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "product_name": {"type": "string"},
+        "orders": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "customer_name": {"type": "string"},
+                    "items": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "color": {"type": ["string", "null"]},
+                                "quantity": {"type": "integer"}
+                            },
+                            "required": ["color", "quantity"],
+                            "additionalProperties": False
+                        }
+                    }
+                },
+                "required": ["customer_name", "items"],
+                "additionalProperties": False
+            }
+        }
+    },
+    "required": ["product_name", "orders"],
+    "additionalProperties": False
+}
+PARSE_CACHE_SIZE = int(os.getenv('PARSE_CACHE_SIZE', 2048))
+PARSE_CACHE_TTL = int(os.getenv('PARSE_CACHE_TTL', 30 * 24 * 3600))  # seconds
+
+# Shared OpenAI client: requests in flight per process, per-attempt timeout and retries of transient errors
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', 8))
+LLM_TIMEOUT = float(os.getenv('LLM_TIMEOUT', 30))  # seconds
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', 3))
+
+# Circuit breaker around LLM parsing: opens after this many consecutive errors or slow calls,
+# then lets a trial call through after the reset timeout. Messages parsed while it is open are
+# stored as parse_pending and re-parsed in the background every PARSE_PENDING_RETRY_INTERVAL.
+LLM_BREAKER_FAILURES = int(os.getenv('LLM_BREAKER_FAILURES', 5))
+LLM_BREAKER_SLOW_CALL = float(os.getenv('LLM_BREAKER_SLOW_CALL', 10))  # seconds
+LLM_BREAKER_RESET_TIMEOUT = float(os.getenv('LLM_BREAKER_RESET_TIMEOUT', 30))  # seconds
+PARSE_PENDING_RETRY_INTERVAL = int(os.getenv('PARSE_PENDING_RETRY_INTERVAL', 60))  # seconds
+
+# How long a message mid is remembered in memory to drop Meta redeliveries
+MESSAGE_DEDUP_TTL = int(os.getenv('MESSAGE_DEDUP_TTL', 600))  # seconds
+# How long one attempt may hold a stored message before another attempt can take it over
+MESSAGE_PROCESSING_LEASE = int(os.getenv('MESSAGE_PROCESSING_LEASE', 300))  # seconds
+
+# How long a User-Id -> (role, belong_to) resolution is reused by the auth decorators.
+# Invalidation is per process, so this also bounds staleness across gunicorn workers.
+IDENTITY_CACHE_TTL = int(os.getenv('IDENTITY_CACHE_TTL', 60))  # seconds
+
+# Source of dashboard stream events: 'local' publishes from this process's write paths,
+# 'change_stream' watches the orders collection (replica set only, sees every process's writes)
+ORDER_EVENTS_SOURCE = os.getenv('ORDER_EVENTS_SOURCE', 'local')
+SSE_KEEPALIVE_INTERVAL = int(os.getenv('SSE_KEEPALIVE_INTERVAL', 15))  # seconds
+# Each open stream holds a gunicorn thread for its whole life, so cap them per worker
+# process well below --threads to leave threads for the API; extra streams get a 503
+SSE_MAX_STREAMS = int(os.getenv('SSE_MAX_STREAMS', 8))
+
+# Serve /api/order-summaries from the order_summaries view instead of aggregating orders
+ORDER_SUMMARY_VIEW_ENABLED = os.getenv('ORDER_SUMMARY_VIEW_ENABLED', 'true').lower() == 'true'
+
+# Customers per page for the preparing, billing and history endpoints (?after=<customer_name>&limit=N)
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# Orders that still pick up product price and image changes; completed orders keep what they were billed with
+OPEN_ORDER_STATUSES = ['pickup', 'preparing', 'billing']
+
+# Largest order_ids list accepted by bulk order endpoints
+MAX_BULK_ORDER_IDS = 1000
+
+# Uploaded images are re-encoded into thumb/card/full variants in this format ('webp' or 'jpeg')
+IMAGE_VARIANT_FORMAT = os.getenv('IMAGE_VARIANT_FORMAT', 'webp')
+
+# Messenger attachment images are mirrored into static/images in the background.
+# URLs written outside a request are PUBLIC_BASE_URL + /static/..., or relative when it is empty.
+PUBLIC_BASE_URL = os.getenv('PUBLIC_BASE_URL', '').rstrip('/')
+ATTACHMENT_FETCH_WORKERS = int(os.getenv('ATTACHMENT_FETCH_WORKERS', 4))
+ATTACHMENT_FETCH_TIMEOUT = float(os.getenv('ATTACHMENT_FETCH_TIMEOUT', 15))  # seconds
+ATTACHMENT_MAX_BYTES = int(os.getenv('ATTACHMENT_MAX_BYTES', 20 * 1024 * 1024))
+ATTACHMENT_FETCH_MAX_ATTEMPTS = 3
+# An order stays claimed by one fetch this long before the sweep assumes the process died
+ATTACHMENT_FETCH_LEASE = timedelta(minutes=10)
+
+# How long storing an image holds it against gc_images.py before the reference is recorded
+IMAGE_STORE_LEASE = timedelta(minutes=10)
+
+# Largest accepted request body, and so largest image upload; enforced while the body is read
+MAX_UPLOAD_BYTES = int(os.getenv('MAX_UPLOAD_BYTES', 10 * 1024 * 1024))
+# Uploads and downloads are written here while they are hashed; outside static/ so they are never served
+IMAGE_TMP_DIR = os.getenv('IMAGE_TMP_DIR', 'tmp/images')
+
+# Files under static/images are named by content hash and never change
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Documents read from MongoDB and written to the client per chunk by streamed JSON responses
+STREAM_BATCH_SIZE = int(os.getenv('STREAM_BATCH_SIZE', 500))
+
+class UploadRequest(Request):
+    """Request whose uploaded files are streamed straight to disk and hashed as they are parsed."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        upload = HashingFile(IMAGE_TMP_DIR, MAX_UPLOAD_BYTES)
+        self.__dict__.setdefault('_uploads', []).append(upload)
+        return upload
+
+    def close(self):
+        super().close()
+        # Remove temporary files that were not stored, including those of an aborted parse
+        for upload in self.__dict__.get('_uploads', ()):
+            upload.close()
 
 app = Flask(__name__, static_folder='static', static_url_path='/static')
+app.request_class = UploadRequest
 CORS(app)
 
 # Configure Flask app for UTF-8 encoding
 app.config['JSON_AS_ASCII'] = False
 app.config['JSONIFY_MIMETYPE'] = 'application/json; charset=utf-8'
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
 
 # Configure logging
 if not os.path.exists('logs'):
@@ -59,9 +214,226 @@ messages_collection = mongo_db.messages
 orders_collection = mongo_db.orders
 users_collection = mongo_db.users
 products_collection = mongo_db.products
+webhook_queue_collection = mongo_db.webhook_queue
+webhook_dead_letter_collection = mongo_db.webhook_dead_letters
+# Last time each webhook_worker.py process was alive, for /api/health
+worker_heartbeats_collection = mongo_db.worker_heartbeats
+parse_cache_collection = mongo_db.parse_cache
+# Pickup quantities per (seller, product, colour), kept up to date by update_order_summaries
+order_summaries_collection = mongo_db.order_summaries
+# Build markers of derived collections, e.g. when order_summaries was last rebuilt
+collection_meta_collection = mongo_db.collection_meta
+# Per-seller version counters of order data, used for dashboard ETags
+order_versions_collection = mongo_db.order_versions
+# One entry per batch of status changes made by transition_orders
+order_transitions_collection = mongo_db.order_transitions
+# Token counts and latency of every LLM parse call
+llm_usage_collection = mongo_db.llm_usage
+# Reference counts of content-addressed images in static/images, for gc_images.py
+image_blobs_collection = mongo_db.image_blobs
+# Batch API jobs submitted by llm_batch.py
+llm_batches_collection = mongo_db.llm_batches
+
+# In-process tier of the LLM parse cache; parse_cache_collection is the persistent tier
+parse_cache = LRUCache(max_size=PARSE_CACHE_SIZE)
+parse_cache_stats = {'memory_hits': 0, 'persistent_hits': 0, 'misses': 0}
+parse_cache_stats_lock = threading.Lock()
+
+# One OpenAI connection pool and concurrency limit shared by every thread of the process
+llm_client = LLMClient(
+    api_key=os.getenv('OPENAI_API_KEY'),
+    max_concurrency=LLM_MAX_CONCURRENCY,
+    timeout=LLM_TIMEOUT,
+    max_retries=LLM_MAX_RETRIES
+)
+
+# Fails LLM parses fast during provider incidents; closing wakes the parse_pending reprocessor
+pending_parse_wakeup = threading.Event()
+llm_breaker = CircuitBreaker(
+    failure_threshold=LLM_BREAKER_FAILURES,
+    # Calls through the breaker get an LLM_BREAKER_SLOW_CALL deadline (see parse_order_with_cache),
+    # so slow requests already fail with a timeout; timing here would include waiting for a slot
+    slow_call_threshold=None,
+    reset_timeout=LLM_BREAKER_RESET_TIMEOUT,
+    # Refusals, truncated or malformed replies come from a healthy provider
+    ignored_exceptions=(ValueError,),
+    # All request slots busy: local load, not a provider failure
+    neutral_exceptions=(LLMBusyError,),
+    on_close=pending_parse_wakeup.set
+)
+
+# Downloads attachment images on a bounded pool sharing one HTTP session
+image_fetcher = ImageFetcher(
+    app.static_folder,
+    IMAGE_TMP_DIR,
+    image_format=IMAGE_VARIANT_FORMAT,
+    workers=ATTACHMENT_FETCH_WORKERS,
+    timeout=ATTACHMENT_FETCH_TIMEOUT,
+    max_bytes=ATTACHMENT_MAX_BYTES
+)
+
+# Copies product price/image changes to open orders off the request path, one product at a time
+product_propagation_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='product-propagation')
+
+# Recently seen message mids, checked before any DB or OpenAI work
+seen_message_ids = LRUCache(max_size=10000, ttl=MESSAGE_DEDUP_TTL)
+
+# User-Id -> {'role', 'belong_to'} for the auth decorators
+identity_cache = LRUCache(max_size=4096, ttl=IDENTITY_CACHE_TTL)
+
+# Per-seller fan-out of order events for /api/stream
+order_events = OrderEventBus()
+sse_stream_slots = threading.BoundedSemaphore(SSE_MAX_STREAMS)
+if ORDER_EVENTS_SOURCE == 'change_stream':
+    start_change_stream_watcher(orders_collection, order_events)
+elif WEBHOOK_QUEUE_ENABLED:
+    app.logger.warning('WEBHOOK_QUEUE_ENABLED with ORDER_EVENTS_SOURCE=local: orders created by '
+                       'webhook_worker.py will not reach /api/stream')
+
+# Version keys for changes affecting every seller (shared products) and any seller at all
+GLOBAL_ORDER_VERSION = '__global__'
+ALL_SELLERS_ORDER_VERSION = '__all__'
+
+def bump_order_version(seller_id):
+    """Invalidate the ETags of a seller's order data (or every seller's for BROADCAST)."""
+    keys = [GLOBAL_ORDER_VERSION] if seller_id is BROADCAST else [seller_id, ALL_SELLERS_ORDER_VERSION]
+    order_versions_collection.bulk_write(
+        [UpdateOne({'_id': key}, {'$inc': {'version': 1}}, upsert=True) for key in keys],
+        ordered=False
+    )
+
+def notify_order_change(seller_id, event_type, **payload):
+    """Record a change to a seller's orders: bump its version and push a dashboard event."""
+    try:
+        bump_order_version(seller_id)
+    except Exception as e:
+        app.logger.error(f'Error bumping order version: {str(e)}')
+
+    # With change streams the watcher publishes every write, including this one
+    if ORDER_EVENTS_SOURCE == 'change_stream':
+        return
+    try:
+        order_events.publish(seller_id, {'type': event_type, **payload})
+    except Exception as e:
+        app.logger.error(f'Error publishing order event: {str(e)}')
+
+# Indexes backing the endpoint queries: (collection, keys, options).
+# Keep db_indexes.py's audit queries in sync when adding or changing queries.
+INDEXES = [
+    # get_orders, get_preparing_orders, get_history_orders (and their keyset pages),
+    # get_order_summaries, mark_all_orders_paid, move_orders_to_billing
+    (orders_collection, [('sender_id', 1), ('status', 1), ('customer_name', 1)], {}),
+    # export_orders
+    (orders_collection, [('sender_id', 1), ('status', 1), ('billing_paid_at', 1)], {}),
+    (orders_collection, [('sender_id', 1), ('status', 1), ('created_at', 1)], {}),
+    # get_billing_orders
+    (orders_collection, [('status', 1), ('customer_name', 1)], {}),
+    # move_orders_to_preparing, propagate_product_change
+    (orders_collection, [('item_name', 1), ('status', 1)], {}),
+    # handle_text_message pending image lookup
+    (orders_collection, [('sender_id', 1), ('customer_name_status', 1)], {}),
+    # replace_message_orders, save_failed_parse, llm_batch.py has_orders
+    (orders_collection, [('message_id', 1)], {}),
+    # mirror_pending_order_images
+    (orders_collection, [('image_fetch_status', 1), ('created_at', 1)], {
+        'partialFilterExpression': {'image_fetch_status': 'pending'}
+    }),
+    (orders_collection, [('image_fetch_status', 1), ('image_fetch_lease_until', 1)], {
+        'partialFilterExpression': {'image_fetch_status': 'fetching'}
+    }),
+    # get_llm_usage
+    (llm_usage_collection, [('created_at', -1)], {}),
+    # user_id_required, owner_required
+    (users_collection, [('facebook_id', 1)], {'unique': True}),
+    # insert_product
+    (products_collection, [('name_lower', 1)], {'unique': True}),
+    # propagate_pending_product_changes
+    (products_collection, [('propagation_pending', 1)], {
+        'partialFilterExpression': {'propagation_pending': True}
+    }),
+    # handle_attachments recent message lookup
+    (messages_collection, [('sender_id', 1), ('created_at', -1)], {}),
+    # get_messages
+    (messages_collection, [('timestamp', -1)], {}),
+    (messages_collection, [('conversation_id', 1), ('timestamp', -1)], {}),
+    # reprocess_pending_parses
+    (messages_collection, [('parse_status', 1), ('parse_pending_at', 1)], {
+        'partialFilterExpression': {'parse_status': {'$exists': True}}
+    }),
+    # store_message idempotency
+    (messages_collection, [('message_id', 1)], {
+        'unique': True,
+        'partialFilterExpression': {'message_id': {'$type': 'string'}}
+    }),
+    # retain_image, release_image, gc_images.py
+    (image_blobs_collection, [('digest', 1)], {'unique': True}),
+    (products_collection, [('image_digest', 1)], {'partialFilterExpression': {'image_digest': {'$type': 'string'}}}),
+    (orders_collection, [('image_digest', 1)], {'partialFilterExpression': {'image_digest': {'$type': 'string'}}}),
+    (image_blobs_collection, [('ref_count', 1), ('updated_at', 1)], {}),
+    (parse_cache_collection, [('key', 1)], {'unique': True}),
+    (parse_cache_collection, [('expires_at', 1)], {'expireAfterSeconds': 0}),
+    # get_order_summaries, update_order_summaries
+    (order_summaries_collection, [('sender_id', 1), ('product_name', 1), ('color', 1)], {'unique': True}),
+    (order_summaries_collection, [('product_name', 1)], {}),
+    # webhook_worker.py job claims
+    (webhook_queue_collection, [('status', 1), ('available_at', 1)], {}),
+    # Drops heartbeats of workers that are long gone
+    (worker_heartbeats_collection, [('seen_at', 1)], {'expireAfterSeconds': 86400}),
+]
+
+def ensure_indexes():
+    """Create the indexes the app relies on; returns the names of any that failed."""
+    failed = []
+    for collection, keys, options in INDEXES:
+        try:
+            collection.create_index(keys, **options)
+        except Exception as e:
+            name = f"{collection.name}.{'_'.join(key for key, _ in keys)}"
+            app.logger.error(f'Error creating index {name}: {str(e)}')
+            failed.append(name)
+    return failed
+
+try:
+    ensure_indexes()
+except Exception as e:
+    app.logger.error(f'Error creating indexes: {str(e)}')
+
 # Meta Webhook configuration
 VERIFY_TOKEN = os.getenv('META_VERIFY_TOKEN', 'your_webhook_verify_token')
 
+def stream_json_response(items, envelope=None, items_key=None):
+    """Stream a JSON array built from an iterable, STREAM_BATCH_SIZE items per chunk.
+
+    With envelope, the array is written as envelope[items_key] of a JSON object,
+    e.g. {"total": 10, "messages": [...]}.
+    """
+    def generate():
+        if envelope is None:
+            yield '['
+        else:
+            head = app.json.dumps(envelope)[:-1]
+            yield f'{head}{", " if envelope else ""}{app.json.dumps(items_key)}: ['
+
+        separator = ''
+        batch = []
+        try:
+            for item in items:
+                batch.append(app.json.dumps(item))
+                if len(batch) >= STREAM_BATCH_SIZE:
+                    yield separator + ','.join(batch)
+                    separator = ','
+                    batch = []
+            if batch:
+                yield separator + ','.join(batch)
+        except Exception as e:
+            # Headers are already sent, so the error can only be logged
+            app.logger.error(f'Error streaming response: {str(e)}', exc_info=True)
+            raise
+
+        yield ']' if envelope is None else ']}'
+
+    return Response(stream_with_context(generate()), content_type=app.config['JSONIFY_MIMETYPE'])
+
 def verify_webhook_signature(request_body, signature):
     """Verify the webhook signature from Meta."""
     if not signature:
@@ -125,28 +497,143 @@ def webhook_handler():
     
     try:
         data = request.get_json()
+
+        if WEBHOOK_QUEUE_ENABLED:
+            # Persist events and acknowledge at once; webhook_worker.py drains the queue
+            queued = enqueue_webhook_events(data)
+            app.logger.info(f'Queued {queued} messaging events')
+            return jsonify({"status": "ok"})
+
         app.logger.info(f'Webhook data: {json.dumps(data, indent=2)}')
-        
-        # Handle different types of updates
-        if data.get('object') == 'page':
-            for entry in data.get('entry', []):
-                # Handle messaging events
-                if 'messaging' in entry:
-                    for messaging in entry['messaging']:
-                        # Skip message_reads events
-                        if 'read' in messaging:
-                            app.logger.info('Skipping message_reads event')
-                            continue
-                        handle_messaging_event(messaging)
-                   
+        dispatch_webhook_payload(data)
         return jsonify({"status": "ok"})
         
     except Exception as e:
         app.logger.error(f'Error processing webhook: {str(e)}', exc_info=True)
         return jsonify({"error": str(e)}), 500
 
-def handle_messaging_event(messaging):
-    """Handle incoming messaging events."""
+def iter_messaging_events(data):
+    """Yield the messaging events of a webhook payload that need processing."""
+    # Handle different types of updates
+    if data.get('object') == 'page':
+        for entry in data.get('entry', []):
+            # Handle messaging events
+            if 'messaging' in entry:
+                for messaging in entry['messaging']:
+                    # Skip message_reads events
+                    if 'read' in messaging:
+                        app.logger.info('Skipping message_reads event')
+                        continue
+                    yield messaging
+
+def dispatch_webhook_payload(data):
+    """Process every messaging event of a webhook payload inline."""
+    for messaging in iter_messaging_events(data):
+        try:
+            handle_messaging_event(messaging)
+        except Exception:
+            # Already logged by handle_messaging_event; keep going with the rest
+            continue
+
+def enqueue_webhook_events(data):
+    """Store the messaging events of a webhook payload in the work queue."""
+    now = datetime.utcnow()
+    jobs = []
+    mids = []
+    for messaging in iter_messaging_events(data):
+        mid = messaging.get('message', {}).get('mid')
+        if mid and mid in seen_message_ids:
+            app.logger.info(f'Skipping redelivered message {mid}')
+            continue
+        jobs.append({
+            'event': messaging,
+            'status': 'pending',
+            'attempts': 0,
+            'available_at': now,
+            'created_at': now,
+            'updated_at': now
+        })
+        if mid:
+            mids.append(mid)
+
+    if jobs:
+        webhook_queue_collection.insert_many(jobs, ordered=False)
+    # Only remember mids once they are safely queued, so a failed insert can be retried by Meta
+    for mid in mids:
+        seen_message_ids.set(mid, True)
+    return len(jobs)
+
+class LLMOutputTruncated(ValueError):
+    """Raised when the LLM reply was cut off by max_tokens."""
+
+class MessageInProgress(Exception):
+    """Raised when another attempt currently holds the processing lease of a message."""
+
+    def __init__(self, mid, processing_until):
+        super().__init__(f'Message {mid} is being processed by another attempt until {processing_until}')
+        self.processing_until = processing_until
+
+def store_message(message_data):
+    """Store an incoming message once per Meta mid and claim it for processing.
+
+    Returns (message_db_id, lease). lease is the processing_until value this
+    attempt holds, or None when the mid was already fully processed and the
+    event must be skipped. Raises MessageInProgress while another attempt
+    holds an unexpired lease on the message.
+    """
+    now = datetime.utcnow()
+    lease = now + timedelta(seconds=MESSAGE_PROCESSING_LEASE)
+    mid = message_data.get('message_id')
+    if not mid:
+        message_data['processing_until'] = lease
+        return messages_collection.insert_one(message_data).inserted_id, lease
+
+    result = messages_collection.update_one(
+        {'message_id': mid},
+        {'$setOnInsert': {**message_data, 'processing_until': lease}},
+        upsert=True
+    )
+    if result.upserted_id is not None:
+        return result.upserted_id, lease
+
+    # Stored by an earlier attempt; take it over only if that attempt failed or its lease expired
+    claimed = messages_collection.find_one_and_update(
+        {
+            'message_id': mid,
+            'processed_at': {'$exists': False},
+            '$or': [
+                {'processing_until': {'$exists': False}},
+                {'processing_until': {'$lt': now}}
+            ]
+        },
+        {'$set': {'processing_until': lease}},
+        projection={'_id': 1}
+    )
+    if claimed:
+        app.logger.info(f'Resuming unprocessed message {mid}')
+        return claimed['_id'], lease
+
+    existing = messages_collection.find_one({'message_id': mid}, {'processed_at': 1, 'processing_until': 1})
+    if existing.get('processed_at'):
+        return existing['_id'], None
+    raise MessageInProgress(mid, existing.get('processing_until') or now)
+
+def release_message(message_db_id, lease):
+    """Give up the processing lease of a message after a failed attempt, so a retry can claim it."""
+    messages_collection.update_one(
+        {'_id': message_db_id, 'processing_until': lease},
+        {'$unset': {'processing_until': ''}}
+    )
+
+def handle_messaging_event(messaging, from_queue=False):
+    """Handle incoming messaging events.
+
+    Queued events were already checked against the seen-set when they were
+    enqueued, so from_queue skips it and relies on the stored message instead.
+    """
+    mid = None
+    message_db_id = None
+    lease = None
     try:
         app.logger.info(f'Processing messaging event: {json.dumps(messaging, indent=2)}')
         # Extract message data
@@ -154,6 +641,14 @@ def handle_messaging_event(messaging):
         recipient_id = messaging.get('recipient', {}).get('id')
         timestamp = messaging.get('timestamp')
         message = messaging.get('message', {})
+        mid = message.get('mid')
+
+        # Drop redeliveries seen recently before doing any DB or OpenAI work
+        if mid and not from_queue:
+            if mid in seen_message_ids:
+                app.logger.info(f'Skipping redelivered message {mid}')
+                return
+            seen_message_ids.set(mid, True)
         
         # Store message in MongoDB
         message_data = {
@@ -171,9 +666,18 @@ def handle_messaging_event(messaging):
             'is_echo': message.get('is_echo', False)
         }
         
-        # Insert message into MongoDB
-        message_result = messages_collection.insert_one(message_data)
-        message_db_id = message_result.inserted_id
+        # Insert message into MongoDB, skipping mids that were already processed
+        try:
+            message_db_id, lease = store_message(message_data)
+        except MessageInProgress:
+            if from_queue:
+                # Retry the job later; the other attempt may still fail
+                raise
+            app.logger.info(f'Skipping message {mid}, another attempt is processing it')
+            return
+        if lease is None:
+            app.logger.info(f'Skipping duplicate message {mid}')
+            return
         app.logger.info(f'Message stored in MongoDB with ID: {message_db_id}')
         # Check if message starts with "create user" command
         if 'text' in message and message['text'].lower().startswith('create user'):
@@ -191,8 +695,11 @@ def handle_messaging_event(messaging):
                             {'facebook_id': facebook_id},
                             {'$set': {'mapped_sender_id': sender_id}}
                         )
+                        # Staff identities derive from the owner's mapping, so drop them all
+                        invalidate_identity()
 
                     app.logger.info(f'Map new user with Facebook ID: {facebook_id}')
+                    mark_message_processed(message_db_id)
                     
                     # Send confirmation message
                     return jsonify({"status": "User created successfully"})
@@ -205,9 +712,27 @@ def handle_messaging_event(messaging):
             handle_text_message(sender_id, message['text'], message_db_id)
         elif 'attachments' in message:
             handle_attachments(sender_id, message['attachments'], message_db_id)
-            
+
+        mark_message_processed(message_db_id)
+
+    except MessageInProgress:
+        # Not a failure of this attempt; webhook_worker.py postpones the job
+        raise
     except Exception as e:
         app.logger.error(f'Error handling messaging event: {str(e)}', exc_info=True)
+        # Let a retry of this event through the seen-set and the message lease
+        if mid:
+            seen_message_ids.delete(mid)
+        if lease is not None:
+            release_message(message_db_id, lease)
+        raise
+
+def mark_message_processed(message_db_id):
+    """Record that a stored message has been fully handled."""
+    messages_collection.update_one(
+        {'_id': message_db_id},
+        {'$set': {'processed_at': datetime.utcnow()}, '$unset': {'processing_until': ''}}
+    )
 
 def handle_text_message(sender_id, text, message_db_id):
     """Handle text messages."""
@@ -233,6 +758,8 @@ def handle_text_message(sender_id, text, message_db_id):
                         }
                     }
                 )
+                pending_image.update({'customer_name': text, 'customer_name_status': 'updated'})
+                notify_order_change(sender_id, 'updated', orders=[serialize_order(pending_image)])
                 return       
         # Process as potential order message
         elif len(text.split()) >= 4:
@@ -243,6 +770,8 @@ def handle_text_message(sender_id, text, message_db_id):
         
     except Exception as e:
         app.logger.error(f'Error handling text message: {str(e)}', exc_info=True)
+        # Leave the message unprocessed so a retry of the event handles it again
+        raise
 
 def handle_attachments(sender_id, attachments, message_db_id):
     """Handle message attachments."""
@@ -284,14 +813,154 @@ def handle_attachments(sender_id, attachments, message_db_id):
                     'quantity': 1,
                     'message_id': message_db_id
                 }
-                                
+                if image_url:
+                    # The CDN URL is signed and expires; a local copy replaces it once downloaded.
+                    # The order is created already claimed for the fetch submitted below.
+                    order_data.update({
+                        'image_source_url': image_url,
+                        'image_fetch_status': 'fetching',
+                        'image_fetch_lease_until': datetime.utcnow() + ATTACHMENT_FETCH_LEASE
+                    })
+
                 # Insert into orders collection
                 result = orders_collection.insert_one(order_data)
+                update_order_summaries([order_data], 1)
                 app.logger.info(f'Image order stored in MongoDB with ID: {result.inserted_id}')
+                notify_order_change(sender_id, 'created', orders=[serialize_order(order_data)])
+                if image_url and not image_fetcher.submit(mirror_order_image, order_data):
+                    release_image_fetch(order_data['_id'])
                 
     except Exception as e:
         app.logger.error(f'Error handling attachments: {str(e)}', exc_info=True)
+        raise
     
+def mirror_order_image(order):
+    """Download an image order's attachment into the image store and point the order at the local copy."""
+    source_url = order['image_source_url']
+    try:
+        relative_path = image_fetcher.download(source_url, before_store=lease_image)
+    except Exception as e:
+        attempts = order.get('image_fetch_attempts', 0) + 1
+        app.logger.warning(f"Could not mirror image of order {order['_id']} (attempt {attempts}): {str(e)}")
+        orders_collection.update_one(
+            {'_id': order['_id']},
+            {
+                '$set': {
+                    'image_fetch_attempts': attempts,
+                    'image_fetch_status': 'pending' if attempts < ATTACHMENT_FETCH_MAX_ATTEMPTS else 'failed'
+                },
+                '$unset': {'image_fetch_lease_until': ''}
+            }
+        )
+        return None
+
+    image_url = f"{PUBLIC_BASE_URL}/static/{relative_path}"
+    digest = stored_image_digest(image_url)
+    retain_image(digest, relative_path)
+    orders_collection.update_one(
+        {'_id': order['_id']},
+        {
+            '$set': {'image_url': image_url, 'image_digest': digest, 'image_fetch_status': 'stored'},
+            '$unset': {'image_fetch_lease_until': ''}
+        }
+    )
+    order_summaries_collection.update_many(
+        {'sender_id': order['sender_id'], 'product_name': order['item_name'], 'image_url': source_url},
+        {'$set': {'image_url': image_url}}
+    )
+    notify_order_change(order['sender_id'], 'image_changed', order_ids=[str(order['_id'])], image_url=image_url)
+    return image_url
+
+def lease_image(digest):
+    """Hold a stored image against gc_images.py while a new copy of it is being stored.
+
+    Call before store_image_file, which may reuse the existing files, and keep the
+    lease until retain_image records the reference. If the collector is deleting
+    the image right now, wait until it is gone, so its files are written again
+    instead of being reused while they disappear.
+    """
+    for _ in range(20):
+        now = datetime.utcnow()
+        try:
+            # While gc_images.py holds 'deleting' the filter misses and the upsert hits the unique index
+            image_blobs_collection.update_one(
+                {'digest': digest, 'deleting': {'$ne': True}},
+                {
+                    '$set': {'lease_until': now + IMAGE_STORE_LEASE, 'updated_at': now},
+                    '$setOnInsert': {'ref_count': 0, 'created_at': now}
+                },
+                upsert=True
+            )
+            return
+        except DuplicateKeyError:
+            time.sleep(0.5)
+    raise RuntimeError(f'Stored image {digest} is still being deleted')
+
+def retain_image(digest, relative_path):
+    """Count one more product or order using a stored image, ending the lease taken to store it."""
+    now = datetime.utcnow()
+    image_blobs_collection.update_one(
+        {'digest': digest},
+        {
+            '$inc': {'ref_count': 1},
+            '$set': {'path': relative_path, 'updated_at': now},
+            '$unset': {'lease_until': ''},
+            '$setOnInsert': {'created_at': now}
+        },
+        upsert=True
+    )
+
+def release_image(image_url):
+    """Count one less user of a stored image; URLs outside the store are ignored."""
+    digest = stored_image_digest(image_url)
+    if digest:
+        image_blobs_collection.update_one(
+            {'digest': digest},
+            {'$inc': {'ref_count': -1}, '$set': {'updated_at': datetime.utcnow()}}
+        )
+
+def image_fetch_claimable(now):
+    """Image orders waiting for a fetch, or whose fetch lease has expired."""
+    return {'$or': [
+        {'image_fetch_status': 'pending'},
+        {'image_fetch_status': 'fetching', 'image_fetch_lease_until': {'$lt': now}}
+    ]}
+
+def claim_image_fetch(order_id):
+    """Claim an image order for one fetch; returns the order, or None if someone else holds it."""
+    now = datetime.utcnow()
+    return orders_collection.find_one_and_update(
+        {'_id': order_id, **image_fetch_claimable(now)},
+        {'$set': {'image_fetch_status': 'fetching', 'image_fetch_lease_until': now + ATTACHMENT_FETCH_LEASE}},
+        projection={'image_source_url': 1, 'image_fetch_attempts': 1, 'sender_id': 1, 'item_name': 1},
+        return_document=ReturnDocument.AFTER
+    )
+
+def release_image_fetch(order_id):
+    """Hand a claimed image order back to the sweep when its fetch could not be queued."""
+    orders_collection.update_one(
+        {'_id': order_id, 'image_fetch_status': 'fetching'},
+        {'$set': {'image_fetch_status': 'pending'}, '$unset': {'image_fetch_lease_until': ''}}
+    )
+
+def mirror_pending_order_images(limit=100):
+    """Queue image orders whose attachment has not been mirrored yet; returns how many were queued."""
+    queued = 0
+    candidates = orders_collection.find(
+        image_fetch_claimable(datetime.utcnow()),
+        {'_id': 1}
+    ).sort('created_at', 1).limit(limit)
+    for candidate in list(candidates):
+        # Claim first, so a fetch still in flight elsewhere is not started twice
+        order = claim_image_fetch(candidate['_id'])
+        if not order:
+            continue
+        if not image_fetcher.submit(mirror_order_image, order):
+            release_image_fetch(order['_id'])
+            break
+        queued += 1
+    return queued
+
 @app.route('/api/login', methods=['GET'])
 def login():
     # Request necessary permissions for messaging and user data
@@ -316,6 +985,37 @@ def login():
     )
     return jsonify({"auth_url": auth_url})
 
+def resolve_identity(user_id):
+    """Return {'role', 'belong_to'} for a User-Id, or None if the user does not exist."""
+    identity = identity_cache.get(user_id)
+    if identity is not None:
+        return identity
+
+    user = users_collection.find_one({'facebook_id': user_id}, {'role': 1, 'owner_id': 1, 'mapped_sender_id': 1})
+    if not user:
+        return None
+
+    if user['role'] == 'staff':
+        # For staff, orders belong to the owner's mapped sender
+        owner = users_collection.find_one({'facebook_id': user['owner_id']}, {'mapped_sender_id': 1})
+        belong_to = owner.get('mapped_sender_id') if owner else None
+    else:
+        # For other roles, use their own ID
+        belong_to = user.get('mapped_sender_id')
+
+    identity = {'role': user['role'], 'belong_to': belong_to}
+    # Only complete resolutions are cached, so a missing owner is looked up again next time
+    if belong_to is not None:
+        identity_cache.set(user_id, identity)
+    return identity
+
+def invalidate_identity(user_id=None):
+    """Drop a cached identity, or every cached identity when user_id is None."""
+    if user_id is None:
+        identity_cache.clear()
+    else:
+        identity_cache.delete(user_id)
+
 def owner_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -324,8 +1024,8 @@ def owner_required(f):
             return jsonify({'error': 'User ID is required'}), 401
 
         # Check if user exists and is an owner
-        user = users_collection.find_one({'facebook_id': owner_id})
-        if not user or user.get('role') != 'owner':
+        identity = resolve_identity(owner_id)
+        if not identity or identity['role'] != 'owner':
             return jsonify({'error': 'Owner access required'}), 403
 
         return f(*args, **kwargs)
@@ -339,27 +1039,59 @@ def user_id_required(f):
             return jsonify({'error': 'User ID is required', 'redirect': '/api/login'}), 401
 
         # Check if user exists
-        user = users_collection.find_one({'facebook_id': user_id})
-        if not user:
+        identity = resolve_identity(user_id)
+        if not identity or identity['belong_to'] is None:
             return jsonify({'error': 'User not found', 'redirect': '/api/login'}), 404
 
-        # Store user role in request for downstream use
-        request.user_role = user['role']
-        # Store user ID in request for downstream use
-        if user['role'] == 'staff':
-            # For staff, get the owner ID
-            owner = users_collection.find_one({'facebook_id': user['owner_id']})
-            if not owner:
-                return jsonify({'error': 'User not found', 'redirect': '/api/login'}), 404
-            request.belong_to = owner['mapped_sender_id']
-        else:
-            # For other roles, use their own ID
-            request.belong_to = user['mapped_sender_id']
+        # Store user role and the sender their orders belong to for downstream use
+        request.user_role = identity['role']
+        request.belong_to = identity['belong_to']
 
         return f(*args, **kwargs)
     return decorated_function
 
 
+def notify_orders_changed(orders, event_type):
+    """Notify once per seller for a batch of changed orders."""
+    order_ids_by_seller = {}
+    for order in orders:
+        order_ids_by_seller.setdefault(order.get('sender_id'), []).append(str(order['_id']))
+    for seller_id, order_ids in order_ids_by_seller.items():
+        notify_order_change(seller_id, event_type, order_ids=order_ids)
+
+def order_data_etag(seller_key):
+    """Build the ETag of the current request from the seller's order data version."""
+    versions = {
+        doc['_id']: doc.get('version', 0)
+        for doc in order_versions_collection.find({'_id': {'$in': [seller_key, GLOBAL_ORDER_VERSION]}})
+    }
+    tag = f"{request.full_path}:{seller_key}:{versions.get(seller_key, 0)}:{versions.get(GLOBAL_ORDER_VERSION, 0)}"
+    return hashlib.sha1(tag.encode('utf-8')).hexdigest()
+
+def order_version_etag(all_sellers=False):
+    """Answer 304 Not Modified, without running the endpoint, while the client's ETag is current.
+
+    Must be applied after user_id_required unless all_sellers is set.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            seller_key = ALL_SELLERS_ORDER_VERSION if all_sellers else request.belong_to
+            etag = order_data_etag(seller_key)
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            # Let browsers keep the response but revalidate it on every request
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return decorated_function
+    return decorator
+
+
 @app.route('/api/callback', methods=['GET'])
 def callback():
     try:
@@ -416,6 +1148,7 @@ def callback():
                 'owner_id': 0
             }
             users_collection.insert_one(new_user)
+            invalidate_identity(user_info['id'])
             app.logger.info(f'Created new owner user: {user_info["id"]}')
                 
         app.logger.info(f'Updated access token for user: {user_info["id"]}')
@@ -431,6 +1164,13 @@ def callback():
         app.logger.error(f'Error in callback: {str(e)}', exc_info=True)
         return jsonify({"error": str(e)}), 500
 
+# Message fields returned by /api/messages
+MESSAGE_API_FIELDS = [
+    'sender_id', 'recipient_id', 'timestamp', 'message', 'created_at', 'conversation_id', 'from',
+    'message_id', 'seq', 'attachments', 'quick_reply', 'is_echo', 'processed_at', 'order_count',
+    'parse_status'
+]
+
 @app.route('/api/messages', methods=['GET'])
 def get_messages():
     """Get messages from MongoDB."""
@@ -445,281 +1185,848 @@ def get_messages():
         if conversation_id:
             query['conversation_id'] = conversation_id
             
-        # Get messages from MongoDB
-        messages = list(messages_collection.find(
-            query,
-            {'_id': 0}  # Exclude MongoDB _id field
-        ).sort('timestamp', -1).skip(skip).limit(limit))
-        
-        # Convert ObjectId to string for JSON serialization
-        for message in messages:
-            message['id'] = str(message.get('_id', ''))
-            if '_id' in message:
-                del message['_id']
-        
-        return jsonify({
-            "messages": messages,
-            "total": messages_collection.count_documents(query)
-        })
+        # Get messages from MongoDB; only the fields stored from the webhook event and the
+        # processing outcome are returned, since internal fields may hold ObjectIds
+        # (e.g. duplicate_of) that cannot be serialized once the response is streaming
+        cursor = messages_collection.find(query, MESSAGE_API_FIELDS).sort('timestamp', -1).skip(skip).limit(limit)
+        cursor.batch_size(STREAM_BATCH_SIZE)
+
+        def serialize(message):
+            # Convert ObjectId to string for JSON serialization
+            message['id'] = str(message.pop('_id'))
+            return message
+
+        return stream_json_response(
+            (serialize(message) for message in cursor),
+            envelope={"total": messages_collection.count_documents(query)},
+            items_key="messages"
+        )
         
     except Exception as e:
         app.logger.error(f'Error fetching messages: {str(e)}', exc_info=True)
         return jsonify({"error": str(e)}), 500
 
-def process_order_message(message_text, message_db_id, sender_id):
-    """Process order message using ChatGPT to extract structured information."""
-    try:
-        # Set OpenAI API key
-        openai.api_key = os.getenv('OPENAI_API_KEY')
-
-        # Create prompt for ChatGPT
-        prompt = f"""You are an order parsing assistant. Your task is to extract structured order information from the following message:
-
-        {message_text}
-
-        The message follows this pattern:
-        [product_name] [quantity1 for customer 1] [color1 for customer 1] (customer1) [quantity1 for customer 2] [color1 for customer 2] [quantity2 for customer 2] [color2 for customer 2] (customer2) ...
-
-        IMPORTANT: Parse the ACTUAL message above, not the example. Return a JSON object with this structure:
-        {{
-            "product_name": "Name of the product",
-            "orders": [
-                {{
-                    "customer_name": "Customer name",
-                    "items": [
-                        {{
-                            "color": "Color name",
-                            "quantity": number
-                        }}
-                    ]
-                }}
-            ]
-        }}
-
-        Now, please parse the actual message provided above and return the structured data."""
+def order_parse_max_tokens(message_text):
+    """Completion token budget for parsing a message, sized from the order lines it may hold.
 
-        # Call OpenAI API with GPT-4
-        response = openai.chat.completions.create(
-            model="gpt-4-turbo",
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant that extracts structured order information from single-line messages. You understand that each customer can have multiple color orders, and the format is: [product_name] [quantity1 for customer 1] [color1 for customer 1] (customer1) [quantity1 for customer 2] [color1 for customer 2] [quantity2 for customer 2] [color2 for customer 2] (customer2) ..."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.1  # Lower temperature for more consistent results
-        )
+    Each quantity becomes an item and each "(name)" a customer entry of the reply,
+    which also repeats the message's names and colours; the estimate is doubled
+    so unusual spellings still fit.
+    """
+    lines = len(re.findall(r'\d+', message_text))
+    customers = message_text.count('(')
+    estimate = 32 + 16 * lines + 12 * customers + len(message_text) // 2
+    return min(LLM_MAX_COMPLETION_TOKENS, 2 * estimate)
+
+def order_parse_request(message_text):
+    """Build the chat completion arguments for parsing a message (shared by live and batch parsing)."""
+    return {
+        "model": LLM_MODEL,
+        "messages": [
+            {"role": "system", "content": ORDER_PARSE_INSTRUCTIONS},
+            {"role": "user", "content": message_text}
+        ],
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {"name": "order_message", "strict": True, "schema": ORDER_PARSE_SCHEMA}
+        },
+        # Output grows with the number of order lines; a cap also bounds latency on runaway output
+        "max_tokens": order_parse_max_tokens(message_text),
+        "temperature": 0.1  # Lower temperature for more consistent results
+    }
+
+def structured_order_from_response(message):
+    """Return the structured order of a chat completion message, or raise if it is not usable."""
+    if message.get('refusal'):
+        raise ValueError(f"LLM refused to parse the message: {message['refusal']}")
+    return json.loads(message['content'])
+
+def order_line_count(structured_order):
+    """Number of order lines a structured order produces."""
+    return sum(len(order.get('items', [])) for order in structured_order.get('orders', []))
+
+def record_llm_usage(usage, structured_order=None, latency_ms=None, mode='live'):
+    """Record the token counts of one parse call so cost and latency can be tracked per order line."""
+    try:
+        llm_usage_collection.insert_one({
+            'model': LLM_MODEL,
+            'prompt_version': PROMPT_VERSION,
+            'mode': mode,
+            'prompt_tokens': usage.get('prompt_tokens', 0),
+            'completion_tokens': usage.get('completion_tokens', 0),
+            'latency_ms': latency_ms,
+            'order_lines': order_line_count(structured_order) if structured_order else 0,
+            'created_at': datetime.utcnow()
+        })
+    except Exception as e:
+        app.logger.error(f'Error recording LLM usage: {str(e)}')
+
+def parse_order_with_llm(message_text, deadline=None, max_retries=None):
+    """Extract structured order information from a message using ChatGPT."""
+    response, request_seconds = llm_client.chat_completion(
+        deadline=deadline,
+        max_retries=max_retries,
+        **order_parse_request(message_text)
+    )
+    latency_ms = round(request_seconds * 1000)
 
+    choice = response.choices[0]
+    structured_order = None
+    try:
+        if choice.finish_reason == 'length':
+            raise LLMOutputTruncated('LLM output was cut off by max_tokens')
         # Get the structured order from the response
-        structured_order = json.loads(response.choices[0].message.content)
-        app.logger.info(f"Processed order message: {structured_order}")
+        structured_order = structured_order_from_response(choice.message.model_dump())
+        return structured_order
+    finally:
+        if response.usage:
+            record_llm_usage(response.usage.model_dump(), structured_order, latency_ms)
+
+def parse_cache_key(message_text):
+    """Build the parse cache key from the normalized message text and prompt/model version."""
+    normalized = ' '.join(message_text.casefold().split())
+    return hashlib.sha256(f"{LLM_MODEL}:{PROMPT_VERSION}:{normalized}".encode('utf-8')).hexdigest()
+
+def count_parse_cache(outcome):
+    """Increment one of the parse cache counters ('memory_hits', 'persistent_hits' or 'misses')."""
+    with parse_cache_stats_lock:
+        parse_cache_stats[outcome] += 1
+
+def cached_parse(message_text):
+    """Return the cached LLM parse of an identical message, or None."""
+    key = parse_cache_key(message_text)
+
+    structured_order = parse_cache.get(key)
+    if structured_order is not None:
+        count_parse_cache('memory_hits')
+        return structured_order
 
-        # Generate a unique order group ID
-        order_group_id = f"order_{int(datetime.utcnow().timestamp())}"
+    cached = parse_cache_collection.find_one(
+        {'key': key, 'expires_at': {'$gt': datetime.utcnow()}},
+        {'result': 1}
+    )
+    if cached:
+        count_parse_cache('persistent_hits')
+        parse_cache.set(key, cached['result'])
+        return cached['result']
+    return None
+
+def parse_order_with_cache(message_text):
+    """Parse a message with the LLM unless an identical message was parsed before."""
+    structured_order = cached_parse(message_text)
+    if structured_order is not None:
+        return structured_order
 
-        # Parse the structured order
-        product_name = structured_order.get('product_name')
-        orders = structured_order.get('orders', [])
+    count_parse_cache('misses')
+    # No retries and a short deadline: a slow provider must not hold the caller's
+    # thread, the message is parked as parse_pending instead
+    structured_order = llm_breaker.call(
+        parse_order_with_llm, message_text, deadline=LLM_BREAKER_SLOW_CALL, max_retries=0
+    )
+    store_parsed_order(message_text, structured_order)
+    return structured_order
+
+def store_parsed_order(message_text, structured_order):
+    """Save an LLM parse result in both tiers of the parse cache."""
+    key = parse_cache_key(message_text)
+    now = datetime.utcnow()
+    parse_cache.set(key, structured_order)
+    parse_cache_collection.update_one(
+        {'key': key},
+        {'$set': {
+            'result': structured_order,
+            'model': LLM_MODEL,
+            'prompt_version': PROMPT_VERSION,
+            'created_at': now,
+            'expires_at': now + timedelta(seconds=PARSE_CACHE_TTL)
+        }},
+        upsert=True
+    )
 
-        # Create Order records and update summary
-        total_quantity = 0
-        for order_data in orders:
-            customer_name = order_data.get('customer_name')
-            items = order_data.get('items', [])
-            
-            for item in items:
-                product_details = insert_product(product_name)
-                price = product_details['price']
-                image_url = product_details['image_url']
-                
-                order = {
-                    "customer_name": customer_name,
-                    "sender_id": sender_id,
-                    "item_name": product_name,
-                    "color": item.get('color'),
-                    "quantity": item.get('quantity', 1),
-                    "status": 'pickup',
-                    "order_group_id": order_group_id,
-                    "created_at": datetime.utcnow(),
-                    "message_id": message_db_id,
-                    "price": price,
-                    "image_url": image_url
-                }
-                orders_collection.insert_one(order)
-                total_quantity += order['quantity']
+def process_order_message(message_text, message_db_id, sender_id):
+    """Process order message, using the local parser first and ChatGPT as a fallback."""
+    try:
+        structured_order, confidence = parse_order_message(message_text)
+        if structured_order and confidence >= ORDER_PARSER_MIN_CONFIDENCE:
+            app.logger.info(f"Parsed order message locally (confidence {confidence}): {structured_order}")
+            parsed_by = 'local'
+        else:
+            app.logger.info(f"Local parse ambiguous (confidence {confidence}), falling back to LLM")
+            try:
+                llm_order = parse_order_with_cache(message_text)
+            except LLMOutputTruncated as e:
+                # Too many lines for the output budget: the local parse is the better answer
+                if not structured_order:
+                    app.logger.error(f"LLM could not parse message {message_db_id}: {str(e)}")
+                    return save_failed_parse(structured_order, message_db_id, sender_id)
+                app.logger.warning(f"{str(e)} for message {message_db_id}, keeping the local parse")
+                return save_structured_order(structured_order, message_db_id, sender_id, 'local')
+            except ValueError as e:
+                # Refused, truncated or malformed reply: retrying would pay for the same answer
+                app.logger.error(f"LLM could not parse message {message_db_id}: {str(e)}")
+                return save_failed_parse(structured_order, message_db_id, sender_id)
+            except Exception as e:
+                # Provider down or slow: keep the webhook fast and re-parse in the background
+                app.logger.warning(f"LLM parse unavailable ({type(e).__name__}), storing message as parse_pending")
+                return save_pending_parse(structured_order, message_db_id, sender_id)
+            app.logger.info(f"Processed order message: {llm_order}")
+            structured_order = llm_order
+            parsed_by = 'llm'
 
-        return structured_order
+        return save_structured_order(structured_order, message_db_id, sender_id, parsed_by)
 
     except Exception as e:
         app.logger.error(f"Error processing order message: {str(e)}", exc_info=True)
         raise
 
+def save_pending_parse(structured_order, message_db_id, sender_id):
+    """Mark a message parse_pending, keeping the local parser's best guess as provisional orders."""
+    messages_collection.update_one(
+        {'_id': message_db_id},
+        {'$set': {'parse_status': 'pending', 'parse_pending_at': datetime.utcnow()}}
+    )
+    if structured_order:
+        save_structured_order(structured_order, message_db_id, sender_id, 'local', parse_status='pending')
+    start_pending_parse_reprocessor()
+    return structured_order
+
+def save_failed_parse(structured_order, message_db_id, sender_id):
+    """Mark a message the LLM could not parse as parse_status 'failed' for the seller to review.
+
+    The local parser's best guess, if any, is kept as provisional orders flagged the same way.
+    """
+    messages_collection.update_one(
+        {'_id': message_db_id},
+        {'$set': {'parse_status': 'failed'}, '$unset': {'parse_pending_at': ''}}
+    )
+    orders_collection.update_many(
+        {'message_id': message_db_id, 'parse_status': 'pending'},
+        {'$set': {'parse_status': 'failed'}}
+    )
+    if structured_order:
+        save_structured_order(structured_order, message_db_id, sender_id, 'local', parse_status='failed')
+    return structured_order
+
+def save_structured_order(structured_order, message_db_id, sender_id, parsed_by, parse_status=None):
+    """Create the order lines of a parsed message and notify the seller's dashboards.
+
+    parsed_by ('local' or 'llm') records which parser produced the lines.
+    """
+    # Generate a unique order group ID
+    order_group_id = f"order_{int(datetime.utcnow().timestamp())}"
+
+    # Parse the structured order
+    product_name = structured_order.get('product_name')
+    orders = structured_order.get('orders', [])
+
+    # Build all order lines first so they can be written in one round-trip
+    order_lines = [
+        (order_data.get('customer_name'), item)
+        for order_data in orders
+        for item in order_data.get('items', [])
+    ]
+    if not order_lines:
+        return structured_order
+
+    # Resolve the product once for the whole message
+    product_details = insert_product(product_name)
+    price = product_details['price']
+    image_url = product_details['image_url']
+    image_digest = stored_image_digest(image_url)
+
+    created_at = datetime.utcnow()
+    order_documents = [
+        {
+            "customer_name": customer_name,
+            "sender_id": sender_id,
+            "item_name": product_name,
+            "color": item.get('color'),
+            "quantity": item.get('quantity', 1),
+            "status": 'pickup',
+            "order_group_id": order_group_id,
+            "created_at": created_at,
+            "message_id": message_db_id,
+            "parsed_by": parsed_by,
+            "price": price,
+            "image_url": image_url,
+            # Lets gc_images.py find the users of a stored image by digest
+            "image_digest": image_digest
+        }
+        for customer_name, item in order_lines
+    ]
+    if parse_status:
+        # Provisional lines from the local parser, replaced once the LLM parse succeeds
+        for order in order_documents:
+            order['parse_status'] = parse_status
+    insert_order_lines(order_documents, message_db_id)
+    notify_order_change(sender_id, 'created', orders=[serialize_order(order) for order in order_documents])
+
+    return structured_order
+
+def replace_message_orders(message, structured_order, parsed_by='llm'):
+    """Replace the orders created from a message with a new parse of it.
+
+    Returns 'replaced', or 'conflict' when some of the existing orders have already
+    moved past pickup; those are left alone and flagged for the seller to review.
+    """
+    existing = list(orders_collection.find({'message_id': message['_id']}))
+    if any(order.get('status') != 'pickup' for order in existing):
+        orders_collection.update_many(
+            {'message_id': message['_id'], 'parse_status': 'pending'},
+            {'$set': {'parse_status': 'conflict'}}
+        )
+        return 'conflict'
+
+    # Delete one by one so only orders still in pickup come off the summaries
+    deleted = [
+        order for order in existing
+        if orders_collection.delete_one({'_id': order['_id'], 'status': 'pickup'}).deleted_count
+    ]
+    if deleted:
+        update_order_summaries(deleted, -1)
+        notify_order_change(message.get('sender_id'), 'deleted', order_ids=[str(order['_id']) for order in deleted])
+
+    save_structured_order(structured_order, message['_id'], message.get('sender_id'), parsed_by)
+    return 'replaced'
+
+def reprocess_pending_parses(limit=100):
+    """Re-parse parse_pending messages with the LLM until none are left or the breaker opens."""
+    reprocessed = 0
+    while reprocessed < limit:
+        now = datetime.utcnow()
+        # Claim one message; a claim older than the lease was abandoned by a dead process
+        message = messages_collection.find_one_and_update(
+            {'$or': [
+                {'parse_status': 'pending'},
+                {'parse_status': 'reprocessing', 'parse_pending_at': {'$lt': now - timedelta(minutes=10)}}
+            ]},
+            {'$set': {'parse_status': 'reprocessing', 'parse_pending_at': now}},
+            sort=[('parse_pending_at', 1)],
+            return_document=ReturnDocument.AFTER
+        )
+        if not message:
+            break
+
+        parsed_by = 'llm'
+        try:
+            structured_order = parse_order_with_cache(message['message'])
+        except LLMOutputTruncated as e:
+            structured_order, _ = parse_order_message(message['message'])
+            if not structured_order:
+                app.logger.error(f"Pending message {message['_id']} could not be parsed: {str(e)}")
+                save_failed_parse(None, message['_id'], message.get('sender_id'))
+                continue
+            app.logger.warning(f"{str(e)} for pending message {message['_id']}, keeping the local parse")
+            parsed_by = 'local'
+        except ValueError as e:
+            app.logger.error(f"Pending message {message['_id']} could not be parsed: {str(e)}")
+            # Its provisional orders were saved when it was parked, so only flag them
+            save_failed_parse(None, message['_id'], message.get('sender_id'))
+            continue
+        except Exception as e:
+            # Still unavailable: release the message and wait for the next wakeup
+            messages_collection.update_one({'_id': message['_id']}, {'$set': {'parse_status': 'pending'}})
+            app.logger.info(f"Pending parse reprocessing paused: {type(e).__name__}")
+            break
+
+        result = replace_message_orders(message, structured_order, parsed_by)
+        messages_collection.update_one(
+            {'_id': message['_id']},
+            {'$set': {'parse_status': result}} if result == 'conflict' else {'$unset': {'parse_status': '', 'parse_pending_at': ''}}
+        )
+        app.logger.info(f"Reprocessed pending message {message['_id']}: {result}")
+        reprocessed += 1
+    return reprocessed
+
+def pending_parse_loop():
+    """Reprocess parse_pending messages whenever the breaker closes or the retry interval passes."""
+    while True:
+        pending_parse_wakeup.wait(PARSE_PENDING_RETRY_INTERVAL)
+        pending_parse_wakeup.clear()
+        try:
+            reprocess_pending_parses()
+        except Exception as e:
+            app.logger.error(f'Error reprocessing pending parses: {str(e)}', exc_info=True)
+
+_pending_parse_thread = None
+_pending_parse_lock = threading.Lock()
+
+def start_pending_parse_reprocessor():
+    """Start this process's parse_pending reprocessor thread if it is not running yet."""
+    global _pending_parse_thread
+    with _pending_parse_lock:
+        if _pending_parse_thread is None or not _pending_parse_thread.is_alive():
+            _pending_parse_thread = threading.Thread(target=pending_parse_loop, name='pending-parse', daemon=True)
+            _pending_parse_thread.start()
+    return _pending_parse_thread
+
+def update_order_summaries(orders, sign, session=None):
+    """Add (sign=1) or remove (sign=-1) pickup orders from the order_summaries view."""
+    deltas = {}
+    for order in orders:
+        key = (order.get('sender_id'), order.get('item_name'), order.get('color'))
+        if key not in deltas:
+            deltas[key] = {'quantity': 0, 'image_url': order.get('image_url', ''), 'price': order.get('price', 0)}
+        deltas[key]['quantity'] += sign * order.get('quantity', 0)
+
+    if not deltas:
+        return
+
+    now = datetime.utcnow()
+    operations = []
+    for (sender_id, product_name, color), delta in deltas.items():
+        update = {'$inc': {'quantity': delta['quantity']}, '$set': {'updated_at': now}}
+        if sign > 0:
+            # New orders carry the product's current image and price
+            update['$set'].update({'image_url': delta['image_url'], 'price': delta['price']})
+        operations.append(UpdateOne(
+            {'sender_id': sender_id, 'product_name': product_name, 'color': color},
+            update,
+            upsert=sign > 0
+        ))
+    order_summaries_collection.bulk_write(operations, ordered=False, session=session)
+
+    if sign < 0:
+        # Drop rows whose pickup orders have all moved on
+        order_summaries_collection.delete_many(
+            {
+                'sender_id': {'$in': list({sender_id for sender_id, _, _ in deltas})},
+                'product_name': {'$in': list({product_name for _, product_name, _ in deltas})},
+                'quantity': {'$lte': 0}
+            },
+            session=session
+        )
+
+def order_summary_pipeline():
+    """Aggregation computing the order_summaries rows from the orders collection."""
+    return [
+        {"$match": {"status": "pickup"}},
+        {"$group": {
+            "_id": {"sender_id": "$sender_id", "product_name": "$item_name", "color": "$color"},
+            "quantity": {"$sum": "$quantity"},
+            "image_url": {"$first": "$image_url"},
+            "price": {"$first": "$price"}
+        }},
+        {"$project": {
+            "_id": 0,
+            "sender_id": "$_id.sender_id",
+            "product_name": "$_id.product_name",
+            "color": "$_id.color",
+            "quantity": 1,
+            "image_url": 1,
+            "price": 1,
+            "updated_at": "$$NOW"
+        }}
+    ]
+
+def rebuild_order_summaries():
+    """Recompute the order_summaries view from the orders collection.
+
+    Pause order writes (webhook handling, webhook_worker.py and the dashboard)
+    while this runs: $inc updates made between the $out and the rename go to
+    the old collection and are lost when the rebuilt one replaces it.
+    """
+    rebuild_collection = 'order_summaries_rebuild'
+    orders_collection.aggregate(order_summary_pipeline() + [{"$out": rebuild_collection}])
+
+    if rebuild_collection in mongo_db.list_collection_names():
+        # Swap the rebuilt view in atomically, then restore its indexes
+        mongo_db[rebuild_collection].rename(order_summaries_collection.name, dropTarget=True)
+        ensure_indexes()
+    else:
+        order_summaries_collection.delete_many({})
+    collection_meta_collection.update_one(
+        {'_id': order_summaries_collection.name},
+        {'$set': {'built_at': datetime.utcnow()}},
+        upsert=True
+    )
+    return order_summaries_collection.count_documents({})
+
+order_summaries_built = threading.Event()
+
+def order_summaries_ready():
+    """Whether the order_summaries view has been built with rebuild_order_summaries.
+
+    Until then it only holds the $inc updates made since the upgrade, so
+    readers fall back to aggregating orders. Once built it stays built, so
+    only the first positive answer is cached.
+    """
+    if order_summaries_built.is_set():
+        return True
+    if collection_meta_collection.find_one({'_id': order_summaries_collection.name, 'built_at': {'$exists': True}}):
+        order_summaries_built.set()
+        return True
+    return False
+
+def insert_order_lines(order_documents, message_db_id):
+    """Insert the order lines of a message in one batch, marking the message processed with them."""
+    def write(session=None):
+        result = orders_collection.insert_many(order_documents, session=session)
+        update_order_summaries(order_documents, 1, session=session)
+        messages_collection.update_one(
+            {'_id': message_db_id},
+            {'$set': {'processed_at': datetime.utcnow(), 'order_count': len(order_documents)}},
+            session=session
+        )
+        return result.inserted_ids
+
+    if not MONGO_TRANSACTIONS_ENABLED:
+        inserted_ids = write()
+    else:
+        # Transactions need a replica set; the orders and the message record commit together
+        with mongo_client.start_session() as session:
+            inserted_ids = session.with_transaction(write)
+
+    app.logger.info(f'Inserted {len(inserted_ids)} order lines for message {message_db_id}')
+    return inserted_ids
+
 def insert_product(product_name):
     """Insert a new product if it doesn't exist and return its price and image URL."""
     try:
         # Convert product name to lowercase for case-insensitive comparison
         product_name_lower = product_name.lower()
-        
-        # Check if product exists (case insensitive)
-        existing_product = products_collection.find_one({
-            'name_lower': product_name_lower
-        })
-        
-        if not existing_product:
-            # Insert new product
-            product_data = {
+        now = datetime.utcnow()
+
+        # Find or create the product in a single round-trip (case insensitive)
+        product = products_collection.find_one_and_update(
+            {'name_lower': product_name_lower},
+            {'$setOnInsert': {
                 'name': product_name,
                 'name_lower': product_name_lower,
-                'created_at': datetime.utcnow(),
-                'updated_at': datetime.utcnow(),
+                'created_at': now,
+                'updated_at': now,
                 'price': 0,
                 'image_url': ''
-            }
-            result = products_collection.insert_one(product_data)
-            app.logger.info(f'New product inserted with ID: {result.inserted_id}')
-            return {'price': 0, 'image_url': ''}
-        
-        app.logger.info(f'Product already exists: {product_name}')
+            }},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+
         return {
-            'price': existing_product.get('price', 0),
-            'image_url': existing_product.get('image_url', '')
+            'price': product.get('price', 0),
+            'image_url': product.get('image_url', '')
         }
         
     except Exception as e:
         app.logger.error(f'Error inserting product: {str(e)}', exc_info=True)
         raise
 
+@app.route('/api/parse-cache/stats', methods=['GET'])
+@owner_required
+def get_parse_cache_stats():
+    """Get hit/miss counters of the LLM parse cache for this worker."""
+    with parse_cache_stats_lock:
+        counters = dict(parse_cache_stats)
+    return jsonify({
+        **counters,
+        'memory_size': len(parse_cache),
+        'persistent_size': parse_cache_collection.estimated_document_count(),
+        'llm_breaker': llm_breaker.stats(),
+        'parse_pending': messages_collection.count_documents({'parse_status': 'pending'})
+    })
+
+@app.route('/api/llm-usage', methods=['GET'])
+@owner_required
+def get_llm_usage():
+    """Get LLM token counts and latency per model and prompt version over the last ?days=N days."""
+    try:
+        days = min(max(request.args.get('days', 7, type=int), 1), 365)
+        rows = llm_usage_collection.aggregate([
+            {"$match": {"created_at": {"$gte": datetime.utcnow() - timedelta(days=days)}}},
+            {"$group": {
+                "_id": {"model": "$model", "prompt_version": "$prompt_version", "mode": "$mode"},
+                "calls": {"$sum": 1},
+                "prompt_tokens": {"$sum": "$prompt_tokens"},
+                "completion_tokens": {"$sum": "$completion_tokens"},
+                "order_lines": {"$sum": "$order_lines"},
+                "avg_latency_ms": {"$avg": "$latency_ms"}
+            }},
+            {"$sort": {"calls": -1}}
+        ])
+
+        usage = []
+        for row in rows:
+            tokens = row['prompt_tokens'] + row['completion_tokens']
+            usage.append({
+                **row['_id'],
+                'calls': row['calls'],
+                'prompt_tokens': row['prompt_tokens'],
+                'completion_tokens': row['completion_tokens'],
+                'order_lines': row['order_lines'],
+                'tokens_per_order_line': round(tokens / row['order_lines'], 1) if row['order_lines'] else None,
+                'avg_latency_ms': round(row['avg_latency_ms']) if row['avg_latency_ms'] is not None else None
+            })
+        return jsonify({'days': days, 'usage': usage})
+    except Exception as e:
+        app.logger.error(f'Error getting LLM usage: {str(e)}', exc_info=True)
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/orders', methods=['GET'])
+@user_id_required
 def get_orders():
-    """Get all orders."""
+    """Get all orders of the caller's seller."""
     try:
-        orders = list(orders_collection.find({}, {'_id': 0}))
-        response = []
-        for order in orders:
-            order_data = {
+        orders = orders_collection.find(
+            {'sender_id': request.belong_to},
+            {'customer_name': 1, 'item_name': 1, 'size': 1, 'color': 1, 'price': 1, 'created_at': 1}
+        ).batch_size(STREAM_BATCH_SIZE)
+
+        def serialize(order):
+            return {
                 'id': str(order['_id']),
                 'customer_name': order.get('customer_name'),
                 'item_name': order.get('item_name'),
                 'size': order.get('size'),
                 'color': order.get('color'),
                 'price': order.get('price'),
-                'created_at': order.get('created_at').isoformat()
+                'created_at': order.get('created_at').isoformat() if order.get('created_at') else None
             }
-            response.append(order_data)
-        return jsonify(response)
+
+        return stream_json_response(serialize(order) for order in orders)
     except Exception as e:
         app.logger.error(f'Error fetching orders: {str(e)}', exc_info=True)
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/order-summaries', methods=['GET'])
 @user_id_required
+@order_version_etag()
 def get_order_summaries():
     """Get all order summaries with color breakdowns."""
     try:
-        # Get all pickup orders grouped by item_name
-        pipeline = [
-            {"$match": {"status": "pickup", "sender_id": request.belong_to}},
-            {"$group": {
-                "_id": "$item_name",
-                "total_quantity": {"$sum": "$quantity"},
-                "colors": {
-                    "$push": {
-                        "color": "$color",
-                        "quantity": "$quantity"
-                    }
-                },
-                "image_url": {
-                    "$first": "$image_url"
-                },
-                "price": {
-                    "$first": "$price"
-                }
-            }}
-        ]
-        order_groups = list(orders_collection.aggregate(pipeline))
-
-        # Convert to summary format
-        summaries = []
-        for group in order_groups:
-            # Skip image orders
-            if group["_id"].startswith("Image Order"):
-                summaries.append({
-                    "product_name": group["_id"],
-                    "total_quantity": 1,
-                    "color_breakdown": {},
-                    "image_url": group["image_url"]
-                })
-                continue
-
-            # Calculate color breakdown
-            color_breakdown = {}
-            for color_info in group["colors"]:
-                color = color_info["color"]
-                if color not in color_breakdown:
-                    color_breakdown[color] = 0
-                color_breakdown[color] += color_info["quantity"]
-
-            summaries.append({
-                "product_name": group["_id"],
-                "total_quantity": group["total_quantity"],
-                "color_breakdown": color_breakdown,
-                "image_url": group["image_url"],
-                "price": group["price"]
-            })
+        if ORDER_SUMMARY_VIEW_ENABLED and order_summaries_ready():
+            return jsonify(read_order_summaries(request.belong_to))
 
+        summaries = aggregate_order_summaries(request.belong_to)
         return jsonify(summaries)
         
     except Exception as e:
         app.logger.error(f'Error getting order summaries: {str(e)}', exc_info=True)
         return jsonify({"error": str(e)}), 500
 
+def aggregate_order_summaries(sender_id):
+    """Build the order summaries of a seller by aggregating their pickup orders.
+
+    Colour breakdowns are computed in MongoDB, so only one document per
+    product (and per image order) is returned to the app.
+    """
+    image_order_pattern = re.compile('^Image Order')
+    pipeline = [
+        {"$match": {"status": "pickup", "sender_id": sender_id}},
+        {"$facet": {
+            "image_orders": [
+                {"$match": {"item_name": image_order_pattern}},
+                {"$group": {
+                    "_id": "$item_name",
+                    "image_url": {"$first": "$image_url"}
+                }}
+            ],
+            "products": [
+                {"$match": {"item_name": {"$not": image_order_pattern}}},
+                # Quantity per (product, colour) first, then one document per product
+                {"$group": {
+                    "_id": {"product_name": "$item_name", "color": "$color"},
+                    "quantity": {"$sum": "$quantity"},
+                    "image_url": {"$first": "$image_url"},
+                    "price": {"$first": "$price"}
+                }},
+                {"$group": {
+                    "_id": "$_id.product_name",
+                    "total_quantity": {"$sum": "$quantity"},
+                    "colors": {"$push": {
+                        # Missing colours are keyed "null", as jsonify would have done
+                        "k": {"$toString": {"$ifNull": ["$_id.color", "null"]}},
+                        "v": "$quantity"
+                    }},
+                    "image_url": {"$first": "$image_url"},
+                    "price": {"$first": "$price"}
+                }},
+                {"$project": {
+                    "total_quantity": 1,
+                    "color_breakdown": {"$arrayToObject": "$colors"},
+                    "image_url": 1,
+                    "price": 1
+                }}
+            ]
+        }}
+    ]
+    result = next(orders_collection.aggregate(pipeline), {"image_orders": [], "products": []})
+
+    summaries = [
+        {
+            "product_name": group["_id"],
+            "total_quantity": 1,
+            "color_breakdown": {},
+            "image_url": variant_url(group.get("image_url"), 'card')
+        }
+        for group in result["image_orders"]
+    ]
+    summaries.extend(
+        {
+            "product_name": group["_id"],
+            "total_quantity": group["total_quantity"],
+            "color_breakdown": group["color_breakdown"],
+            "image_url": variant_url(group.get("image_url"), 'card'),
+            "price": group.get("price")
+        }
+        for group in result["products"]
+    )
+    return summaries
+
+def read_order_summaries(sender_id):
+    """Build the order summaries of a seller from the order_summaries view."""
+    rows = order_summaries_collection.find(
+        {'sender_id': sender_id, 'quantity': {'$gt': 0}},
+        {'_id': 0, 'product_name': 1, 'color': 1, 'quantity': 1, 'image_url': 1, 'price': 1}
+    )
+
+    summaries = {}
+    for row in rows:
+        product_name = row['product_name']
+        if product_name.startswith("Image Order"):
+            summaries[product_name] = {
+                "product_name": product_name,
+                "total_quantity": 1,
+                "color_breakdown": {},
+                "image_url": variant_url(row.get('image_url'), 'card')
+            }
+            continue
+
+        if product_name not in summaries:
+            summaries[product_name] = {
+                "product_name": product_name,
+                "total_quantity": 0,
+                "color_breakdown": {},
+                "image_url": variant_url(row.get('image_url'), 'card'),
+                "price": row.get('price')
+            }
+        summary = summaries[product_name]
+        summary["total_quantity"] += row['quantity']
+        # Missing colours are keyed "null" like aggregate_order_summaries; a None key
+        # would break jsonify's sorted keys next to string keys
+        color = row.get('color')
+        summary["color_breakdown"]["null" if color is None else str(color)] = row['quantity']
+
+    return list(summaries.values())
+
+def propagation_marker():
+    """Product fields flagging a price/image change that open orders have not picked up yet."""
+    return {'propagation_pending': True, 'propagation_version': ObjectId(), 'updated_at': datetime.utcnow()}
+
+def propagate_product_change(product_name):
+    """Copy a product's current price and image to its open orders; returns how many changed."""
+    product = products_collection.find_one(
+        {'name_lower': product_name.lower()},
+        {'price': 1, 'image_url': 1, 'propagation_version': 1}
+    )
+    if not product:
+        return 0
+
+    result = orders_collection.update_many(
+        {'item_name': product_name, 'status': {'$in': OPEN_ORDER_STATUSES}},
+        {'$set': {
+            'price': product.get('price', 0),
+            'image_url': product.get('image_url', ''),
+            'image_digest': stored_image_digest(product.get('image_url'))
+        }}
+    )
+    # Clear the flag unless the product changed again meanwhile (that change is propagated next)
+    products_collection.update_one(
+        {'_id': product['_id'], 'propagation_version': product.get('propagation_version')},
+        {'$unset': {'propagation_pending': ''}}
+    )
+    if result.modified_count:
+        # Bump every seller's order version so dashboards stop getting 304s for the old values
+        notify_order_change(BROADCAST, 'product_propagated', product_name=product_name, order_count=result.modified_count)
+    app.logger.info(f'Propagated {product_name} to {result.modified_count} open orders')
+    return result.modified_count
+
+def run_product_propagation(product_name):
+    """Propagate a product change, logging failures instead of raising."""
+    try:
+        propagate_product_change(product_name)
+    except Exception as e:
+        # The product stays flagged, so webhook_worker.py retries it
+        app.logger.error(f'Error propagating product {product_name}: {str(e)}', exc_info=True)
+
+def schedule_product_propagation(product_name):
+    """Queue a product's change for its open orders without blocking the request."""
+    product_propagation_executor.submit(run_product_propagation, product_name)
+
+def propagate_pending_product_changes(limit=100):
+    """Propagate products still flagged after a failure or restart; returns how many were handled."""
+    handled = 0
+    for product in products_collection.find({'propagation_pending': True}, {'name': 1}).limit(limit):
+        run_product_propagation(product['name'])
+        handled += 1
+    return handled
+
 @app.route('/api/order-summaries/<product_name>/image', methods=['PUT'])
 def update_product_image(product_name):
     """Update the image for a product."""
     try:
-        if 'image' not in request.files:
+        try:
+            # Parsing the body streams the file to disk (see UploadRequest), stopping at the size cap
+            files = request.files
+        except (RequestEntityTooLarge, ImageTooLarge):
+            return jsonify({"error": f"Image must be at most {MAX_UPLOAD_BYTES} bytes"}), 413
+
+        if 'image' not in files:
             return jsonify({"error": "No image file provided"}), 400
 
-        image_file = request.files['image']
+        image_file = files['image']
         if image_file.filename == '':
             return jsonify({"error": "No selected file"}), 400
 
-        if not image_file.content_type.startswith('image/'):
+        # Trust the file's leading bytes, not the client's content type
+        upload = image_file.stream
+        if not sniff_image_type(upload.head):
+            return jsonify({"error": "File must be an image"}), 400
+
+        # Store by content hash (computed while the upload was written), so re-uploading reuses its files
+        digest = upload.hexdigest
+        tmp_path = upload.detach()
+        try:
+            lease_image(digest)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        try:
+            # Resized, metadata-free variants; the full one is the product's image_url
+            relative_path = store_image_file(tmp_path, digest, app.static_folder, IMAGE_VARIANT_FORMAT)
+        except (OSError, ValueError):
             return jsonify({"error": "File must be an image"}), 400
 
-        # Generate unique filename
-        timestamp = datetime.utcnow().strftime('%Y%m%d%H%M%S')
-        filename = f"{product_name.lower().replace(' ', '_')}_{timestamp}.{image_file.filename.split('.')[-1]}"
-        
-        # Save file to local storage
-        upload_folder = os.path.join(app.static_folder, 'uploads')
-        if not os.path.exists(upload_folder):
-            os.makedirs(upload_folder)
-            
-        file_path = os.path.join(upload_folder, filename)
-        image_file.save(file_path)
-        
-        # Generate URL for the saved image
         # Generate full URL including domain for the image
-        image_url = request.host_url.rstrip('/') + f"/static/uploads/{filename}"
+        image_url = request.host_url.rstrip('/') + f"/static/{relative_path}"
+        retain_image(digest, relative_path)
         
         # Update all orders for this product with the new image URL
-        orders_collection.update_many(
-            {"item_name": product_name},
-            {"$set": {"image_url": image_url}}
+        # Update product in products collection; open orders follow in the background
+        product = products_collection.find_one_and_update(
+            {"name_lower": product_name.lower()},
+            {"$set": {"image_url": image_url, "image_digest": digest, **propagation_marker()}},
+            projection={'image_url': 1}
         )
 
-        # Update product in products collection
-        result = products_collection.update_one(
-            {"name_lower": product_name.lower()},
+        # The replaced image loses its reference (or the new one, if nothing uses it)
+        release_image(product.get('image_url') if product else image_url)
+        if product is None:
+            return jsonify({"error": "Product not found"}), 404
+
+        order_summaries_collection.update_many(
+            {"product_name": product_name},
             {"$set": {"image_url": image_url}}
         )
+        schedule_product_propagation(product_name)
 
-        if result.modified_count == 0:
-            return jsonify({"error": "Product not found"}), 404
+        # Products are shared by all sellers, so every dashboard is told
+        notify_order_change(BROADCAST, 'image_changed', product_name=product_name, image_url=image_url)
 
         return jsonify({
             "message": "Product image updated successfully", 
             "product_name": product_name,
-            "image_url": image_url
+            "image_url": image_url,
+            "image_variants": {variant: variant_url(image_url, variant) for variant in VARIANTS}
         })
 
     except Exception as e:
@@ -738,20 +2045,24 @@ def update_product_price(product_name):
         if price < 0:
             return jsonify({"error": "Price cannot be negative"}), 400
 
-        # Update all orders for this product with the new price
-        result = orders_collection.update_many(
-            {"item_name": product_name},
-            {"$set": {"price": price}}
-        )
-
+        # Update the product; open orders follow in the background
         result = products_collection.update_one(
             {"name_lower": product_name.lower()},
-            {"$set": {"price": price}}
+            {"$set": {"price": price, **propagation_marker()}}
         )
 
-        if result.modified_count == 0:
+        if result.matched_count == 0:
             return jsonify({"error": "Product not found"}), 404
 
+        order_summaries_collection.update_many(
+            {"product_name": product_name},
+            {"$set": {"price": price}}
+        )
+        schedule_product_propagation(product_name)
+
+        # Products are shared by all sellers, so every dashboard is told
+        notify_order_change(BROADCAST, 'price_changed', product_name=product_name, price=price)
+
         return jsonify({
             "message": "Product price updated successfully",
             "product_name": product_name,
@@ -762,124 +2073,356 @@ def update_product_price(product_name):
         app.logger.error(f'Error updating product price: {str(e)}', exc_info=True)
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/stream', methods=['GET'])
+def stream_order_events():
+    """Stream order pipeline events for the user's seller as Server-Sent Events."""
+    # EventSource cannot send custom headers, so the user ID may also come as a query parameter
+    user_id = request.headers.get('User-Id') or request.args.get('user_id')
+    if not user_id:
+        return jsonify({'error': 'User ID is required', 'redirect': '/api/login'}), 401
+
+    identity = resolve_identity(user_id)
+    if not identity or identity['belong_to'] is None:
+        return jsonify({'error': 'User not found', 'redirect': '/api/login'}), 404
+
+    if not sse_stream_slots.acquire(blocking=False):
+        app.logger.warning(f'Rejecting event stream, all {SSE_MAX_STREAMS} stream slots are in use')
+        response = jsonify({'error': 'Too many open event streams, retry later'})
+        response.headers['Retry-After'] = '30'
+        return response, 503
+
+    seller_id = identity['belong_to']
+    subscription = order_events.subscribe(seller_id)
+
+    def generate():
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                try:
+                    event = subscription.get(timeout=SSE_KEEPALIVE_INTERVAL)
+                except queue.Empty:
+                    # Comment lines keep proxies from closing an idle connection
+                    yield ': keepalive\n\n'
+                    continue
+                yield f"event: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False, default=str)}\n\n"
+        finally:
+            order_events.unsubscribe(seller_id, subscription)
+
+    response = Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    # Runs when the server closes the response, even if the generator never started
+    response.call_on_close(sse_stream_slots.release)
+    return response
+
+def customer_page_params():
+    """Read the after/limit keyset pagination parameters; limit is None when not paginating."""
+    after = request.args.get('after')
+    limit = request.args.get('limit', type=int)
+    if limit is None and after is None:
+        return None, None
+    limit = min(max(limit or DEFAULT_PAGE_SIZE, 1), MAX_PAGE_SIZE)
+    return after, limit
+
+def customer_order_groups(match):
+    """Group the orders matching match by customer, one page of customers at a time.
+
+    Returns (groups, next_cursor, paginated), where groups is a lazy iterator so
+    responses can be streamed. Each group has customer_name (absent
+    when the orders have none), orders, total_items and total_amount. Without
+    pagination parameters every customer is returned.
+    """
+    after, limit = customer_page_params()
+    paginated = limit is not None
+    next_cursor = None
+
+    match = dict(match)
+    if paginated:
+        if after is not None:
+            match['customer_name'] = {'$gt': after}
+
+        # Walk the (status, customer_name) index just far enough to find this page's customers
+        customer_names = []
+        cursor = orders_collection.find(match, {'_id': 0, 'customer_name': 1}).sort('customer_name', 1)
+        for order in cursor:
+            customer_name = order.get('customer_name')
+            if customer_names and customer_names[-1] == customer_name:
+                continue
+            if len(customer_names) == limit:
+                # Orders without a customer sort first, so '' resumes right after them
+                next_cursor = customer_names[-1] if customer_names[-1] is not None else ''
+                break
+            customer_names.append(customer_name)
+        cursor.close()
+
+        if not customer_names:
+            return iter(()), None, paginated
+        match['customer_name'] = {'$in': customer_names}
+
+    pipeline = [
+        {"$match": match},
+        {"$sort": {"customer_name": 1, "created_at": 1}},
+        {"$group": {
+            "_id": "$customer_name",
+            "has_customer_name": {"$max": {"$ne": [{"$type": "$customer_name"}, "missing"]}},
+            "orders": {"$push": "$$ROOT"},
+            "total_items": {"$sum": {"$ifNull": ["$quantity", 0]}},
+            "total_amount": {"$sum": {"$multiply": [
+                {"$ifNull": ["$price", 0]},
+                {"$ifNull": ["$quantity", 0]}
+            ]}}
+        }},
+        {"$sort": {"_id": 1}}
+    ]
+
+    def groups():
+        for group in orders_collection.aggregate(pipeline, batchSize=STREAM_BATCH_SIZE):
+            customer_group = {
+                'orders': group['orders'],
+                'total_items': group['total_items'],
+                'total_amount': group['total_amount']
+            }
+            if group['has_customer_name']:
+                customer_group['customer_name'] = group['_id']
+            yield customer_group
+
+    return groups(), next_cursor, paginated
+
+def customer_page_response(customers, next_cursor, paginated):
+    """Stream customer groups, wrapped with the page cursor when paginating."""
+    if not paginated:
+        return stream_json_response(customers)
+    return stream_json_response(customers, envelope={'next_cursor': next_cursor}, items_key='customers')
+
 @app.route('/api/orders/preparing', methods=['GET'])
 @user_id_required
+@order_version_etag()
 def get_preparing_orders():
     """Get orders in preparation phase, grouped by customer."""
     try:
        
-        # Get all orders in preparing status
-        orders = list(orders_collection.find(
-            {"status": "preparing", 
-             "sender_id": request.belong_to
-            }))
-        
-        # Group orders by customer
-        customer_orders = {}
-        for order in orders:
+        groups, next_cursor, paginated = customer_order_groups(
+            {"status": "preparing", "sender_id": request.belong_to}
+        )
+
+        def format_group(group):
             # Use a default customer name if none is provided
-            customer_name = order.get('customer_name', 'Unknown Customer')
-            if customer_name not in customer_orders:
-                customer_orders[customer_name] = {
+            customer_name = group['customer_name'] if 'customer_name' in group else 'Unknown Customer'
+            orders = []
+            for order in group['orders']:
+                # Create a copy of the order without MongoDB-specific fields
+                orders.append({
+                    '_id': str(order['_id']),  # Convert ObjectId to string
                     'customer_name': customer_name,
-                    'orders': [],
-                    'total_items': 0
-                }
-
-            # Create a copy of the order without MongoDB-specific fields
-            order_data = {
-                '_id': str(order['_id']),  # Convert ObjectId to string
+                    'item_name': order.get('item_name', 'Unknown Item'),
+                    'color': order.get('color', 'N/A'),
+                    'quantity': order.get('quantity', 0),
+                    'status': order.get('status', 'preparing'),
+                    'order_group_id': order.get('order_group_id'),
+                    'image_url': variant_url(order.get('image_url', ''), 'thumb'),
+                    'preparation_notes': order.get('preparation_notes', ''),
+                    'preparation_started_at': order.get('preparation_started_at'),
+                    'created_at': order.get('created_at').isoformat() if order.get('created_at') else None,
+                    'updated_at': order.get('updated_at').isoformat() if order.get('updated_at') else None
+                })
+            return {
                 'customer_name': customer_name,
-                'item_name': order.get('item_name', 'Unknown Item'),
-                'color': order.get('color', 'N/A'),
-                'quantity': order.get('quantity', 0),
-                'status': order.get('status', 'preparing'),
-                'order_group_id': order.get('order_group_id'),
-                'image_url': order.get('image_url', ''),
-                'preparation_notes': order.get('preparation_notes', ''),
-                'preparation_started_at': order.get('preparation_started_at'),
-                'created_at': order.get('created_at').isoformat() if order.get('created_at') else None,
-                'updated_at': order.get('updated_at').isoformat() if order.get('updated_at') else None
+                'orders': orders,
+                'total_items': group['total_items']
             }
-            
-            # Add order to customer's list
-            customer_orders[customer_name]['orders'].append(order_data)
-            customer_orders[customer_name]['total_items'] += order.get('quantity', 0)
-        
-        # Convert to list and sort by customer name
-        result = list(customer_orders.values())
-        result.sort(key=lambda x: x['customer_name'] or 'Unknown Customer')
-        
-        return jsonify(result)
+
+        return customer_page_response(map(format_group, groups), next_cursor, paginated)
     except Exception as e:
         app.logger.error(f'Error fetching preparing orders: {str(e)}', exc_info=True)
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/orders/billing', methods=['GET'])
+@order_version_etag(all_sellers=True)
 def get_billing_orders():
     """Get orders in billing phase, grouped by customer."""
     try:
-        # Get all orders in billing status
-        orders = list(orders_collection.find({"status": "billing"}))
-        
-        # Group orders by customer
-        customer_orders = {}
-        for order in orders:
-            customer_name = order.get('customer_name')
-            if customer_name not in customer_orders:
-                customer_orders[customer_name] = {
-                    'customer_name': customer_name,
-                    'orders': [],
-                    'total_amount': 0
-                }
-            
-            # Create a copy of the order without MongoDB-specific fields
-            order_data = {
-                '_id': str(order['_id']),
-                'customer_name': order.get('customer_name'),
-                'item_name': order.get('item_name'),
-                'color': order.get('color'),
-                'quantity': order.get('quantity', 0),
-                'price': order.get('price', 0),
-                'image_url': order.get('image_url', ''),
-                'subtotal': order.get('price', 0) * order.get('quantity', 0),
-                'status': order.get('status'),
-                'order_group_id': order.get('order_group_id'),
-                'billing_notes': order.get('billing_notes', ''),
-                'created_at': order.get('created_at').isoformat() if order.get('created_at') else None,
-                'updated_at': order.get('updated_at').isoformat() if order.get('updated_at') else None
+        groups, next_cursor, paginated = customer_order_groups({"status": "billing"})
+
+        def format_group(group):
+            orders = []
+            for order in group['orders']:
+                # Create a copy of the order without MongoDB-specific fields
+                orders.append({
+                    '_id': str(order['_id']),
+                    'customer_name': order.get('customer_name'),
+                    'item_name': order.get('item_name'),
+                    'color': order.get('color'),
+                    'quantity': order.get('quantity', 0),
+                    'price': order.get('price', 0),
+                    'image_url': variant_url(order.get('image_url', ''), 'thumb'),
+                    'subtotal': order.get('price', 0) * order.get('quantity', 0),
+                    'status': order.get('status'),
+                    'order_group_id': order.get('order_group_id'),
+                    'billing_notes': order.get('billing_notes', ''),
+                    'created_at': order.get('created_at').isoformat() if order.get('created_at') else None,
+                    'updated_at': order.get('updated_at').isoformat() if order.get('updated_at') else None
+                })
+            return {
+                'customer_name': group.get('customer_name'),
+                'orders': orders,
+                'total_amount': group['total_amount']
             }
-            
-            # Add order to customer's list and update total
-            customer_orders[customer_name]['orders'].append(order_data)
-            customer_orders[customer_name]['total_amount'] += order_data['subtotal']
-        
-        # Convert to list and sort by customer name
-        result = list(customer_orders.values())
-        result.sort(key=lambda x: x['customer_name'] or 'Unknown Customer')
-        
-        return jsonify(result)
+
+        return customer_page_response(map(format_group, groups), next_cursor, paginated)
     except Exception as e:
         app.logger.error(f'Error fetching billing orders: {str(e)}', exc_info=True)
         return jsonify({"error": str(e)}), 500
 
+# Dashboard event published for each target status of transition_orders
+TRANSITION_EVENTS = {
+    'preparing': 'preparing',
+    'billing': 'billing',
+    'completed': 'paid'
+}
+
+def transition_orders(query, from_status, to_status, extra_fields=None):
+    """Move every order matching query from from_status to to_status in one update_many.
+
+    The batch is tagged with a transition ID so exactly the orders it changed
+    can be read back, even if other requests touch the same orders. The read-back
+    repeats query so it uses the same index as the update. Returns
+    {'transition_id', 'count', 'order_ids'} and records an order_transitions entry.
+    """
+    transition_id = ObjectId()
+    now = datetime.utcnow()
+    update = {
+        "status": to_status,
+        "updated_at": now,
+        "transition_id": transition_id,
+        **(extra_fields or {})
+    }
+
+    result = orders_collection.update_many({**query, "status": from_status}, {"$set": update})
+    if result.modified_count == 0:
+        return {'transition_id': None, 'count': 0, 'order_ids': []}
+
+    orders = list(orders_collection.find(
+        {**query, "status": to_status, "transition_id": transition_id},
+        {'sender_id': 1, 'item_name': 1, 'color': 1, 'quantity': 1}
+    ))
+    order_ids = [order['_id'] for order in orders]
+
+    order_transitions_collection.insert_one({
+        '_id': transition_id,
+        'from_status': from_status,
+        'to_status': to_status,
+        'query': {key: value for key, value in query.items() if key != '_id'},
+        'order_ids': order_ids,
+        'count': len(order_ids),
+        'user_id': request.headers.get('User-Id') if has_request_context() else None,
+        'created_at': now
+    })
+
+    if from_status == 'pickup':
+        update_order_summaries(orders, -1)
+    notify_orders_changed(orders, TRANSITION_EVENTS.get(to_status, 'updated'))
+
+    return {
+        'transition_id': str(transition_id),
+        'count': len(order_ids),
+        'order_ids': [str(order_id) for order_id in order_ids]
+    }
+
+@app.route('/api/orders/move-to-billing', methods=['POST'])
+@user_id_required
+def move_orders_to_billing():
+    """Move many of the seller's preparing orders to billing, by IDs or by customer."""
+    try:
+        data = request.get_json()
+        if not data or ('order_ids' not in data and 'customer_name' not in data):
+            return jsonify({"error": "order_ids or customer_name is required"}), 400
+
+        if 'customer_name' in data:
+            transition = transition_orders(
+                {"customer_name": data['customer_name'], "sender_id": request.belong_to},
+                'preparing',
+                'billing'
+            )
+            results = [{"order_id": order_id, "result": "moved"} for order_id in transition['order_ids']]
+            return jsonify({**transition, "results": results})
+
+        order_ids = data['order_ids']
+        if not isinstance(order_ids, list) or not order_ids:
+            return jsonify({"error": "order_ids must be a non-empty list"}), 400
+        if len(order_ids) > MAX_BULK_ORDER_IDS:
+            return jsonify({"error": f"At most {MAX_BULK_ORDER_IDS} orders can be moved at once"}), 400
+
+        if not all(isinstance(order_id, str) for order_id in order_ids):
+            return jsonify({"error": "order_ids must be strings"}), 400
+
+        # Results are keyed by the IDs as sent; ObjectId hex is normalized to lowercase
+        results = {}
+        input_ids = {}
+        for order_id in order_ids:
+            if ObjectId.is_valid(order_id):
+                input_ids.setdefault(str(ObjectId(order_id)), []).append(order_id)
+            else:
+                results[order_id] = {"order_id": order_id, "result": "invalid_id"}
+
+        def set_result(normalized_id, result):
+            for order_id in input_ids[normalized_id]:
+                results[order_id] = {**result, "order_id": order_id}
+
+        object_ids = [ObjectId(normalized_id) for normalized_id in input_ids]
+        transition = transition_orders(
+            {"_id": {"$in": object_ids}, "sender_id": request.belong_to},
+            'preparing',
+            'billing'
+        ) if object_ids else {'transition_id': None, 'count': 0, 'order_ids': []}
+
+        for normalized_id in transition['order_ids']:
+            set_result(normalized_id, {"result": "moved"})
+
+        # Explain why the remaining orders did not move
+        moved = set(transition['order_ids'])
+        remaining = [object_id for object_id in object_ids if str(object_id) not in moved]
+        if remaining:
+            current = orders_collection.find(
+                {"_id": {"$in": remaining}, "sender_id": request.belong_to},
+                {"status": 1}
+            )
+            found = set()
+            for order in current:
+                found.add(str(order['_id']))
+                set_result(str(order['_id']), {"result": "not_preparing", "status": order.get('status')})
+            for object_id in remaining:
+                if str(object_id) not in found:
+                    set_result(str(object_id), {"result": "not_found"})
+
+        return jsonify({
+            "transition_id": transition['transition_id'],
+            "count": transition['count'],
+            "results": [results[order_id] for order_id in dict.fromkeys(order_ids)]
+        })
+
+    except Exception as e:
+        app.logger.error(f'Error moving orders to billing: {str(e)}', exc_info=True)
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/orders/<order_id>/move-to-billing', methods=['POST'])
+@user_id_required
 def move_to_billing(order_id):
-    """Move an order to billing phase."""
+    """Move one of the seller's orders to billing phase."""
     try:
-        order = orders_collection.find_one({"_id": ObjectId(order_id)})
-        if not order:
-            return jsonify({"error": "Order not found"}), 404
-        
-        # Update order status and add image URL if it exists
-        update_data = {"status": "billing"}
-            
-        orders_collection.update_one(
-            {"_id": ObjectId(order_id)},
-            {"$set": update_data}
+        if not ObjectId.is_valid(order_id):
+            return jsonify({"error": "Invalid order ID"}), 400
+
+        transition = transition_orders(
+            {"_id": ObjectId(order_id), "sender_id": request.belong_to},
+            'preparing',
+            'billing'
         )
+        if not transition['count']:
+            return jsonify({"error": "Order not found or not in preparing phase"}), 404
 
-        return jsonify({"message": "Order moved to billing phase"})
+        return jsonify({"message": "Order moved to billing phase", **transition})
     except Exception as e:
         app.logger.error(f'Error moving order to billing: {str(e)}', exc_info=True)
         return jsonify({"error": str(e)}), 500
@@ -899,10 +2442,13 @@ def update_preparation_notes(order_id):
         if 'notes' in data:
             update_data['preparation_notes'] = data['notes']
 
-        orders_collection.update_one(
+        order = orders_collection.find_one_and_update(
             {"_id": ObjectId(order_id)},
-            {"$set": update_data}
+            {"$set": update_data},
+            projection={'sender_id': 1}
         )
+        if order:
+            notify_order_change(order.get('sender_id'), 'updated', order_ids=[order_id], preparation_notes=data['notes'])
 
         return jsonify({"message": "Preparation notes updated successfully"})
 
@@ -911,40 +2457,28 @@ def update_preparation_notes(order_id):
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/orders/move-to-preparing', methods=['POST'])
+@user_id_required
 @owner_required
 def move_orders_to_preparing():
-    """Move all orders for a product to preparing status."""
+    """Move all of the seller's pickup orders for a product to preparing status."""
     try:
         data = request.get_json()
         if not data or 'product_name' not in data:
             return jsonify({"error": "Product name is required"}), 400
 
         product_name = data['product_name']
-        
-        # Find all orders for this product with pickup status
-        orders = list(orders_collection.find({
-            "item_name": product_name,
-            "status": "pickup"
-        }))
-        
-        if not orders:
-            return jsonify({"message": "No orders found to move"}), 200
-
-        # Update each order and create preparation records
-        for order in orders:
-            # Update order status and add image URL if it exists
-            update_data = {
-                "status": "preparing",
-                "updated_at": datetime.utcnow()
-            }
-                
-            orders_collection.update_one(
-                {"_id": order['_id']},
-                {"$set": update_data}
-            )
+        transition = transition_orders(
+            {"item_name": product_name, "sender_id": request.belong_to},
+            'pickup',
+            'preparing'
+        )
+
+        if not transition['count']:
+            return jsonify({"message": "No orders found to move", **transition}), 200
 
         return jsonify({
-            "message": f"Successfully moved {len(orders)} orders to preparing status"
+            "message": f"Successfully moved {transition['count']} orders to preparing status",
+            **transition
         })
 
     except Exception as e:
@@ -957,56 +2491,167 @@ def move_orders_to_preparing():
 def get_history_orders():
     """Get completed orders, grouped by customer."""
     try:
-        # Get all orders with status "completed"
-        orders = list(orders_collection.find(
-            {"status": "completed", 
-             "sender_id": request.belong_to
-            }))
-        
-        # Group orders by customer
-        customer_orders = {}
-        for order in orders:
-            customer_name = order.get('customer_name')
-            if customer_name not in customer_orders:
-                customer_orders[customer_name] = {
-                    'customer_name': customer_name,
-                    'orders': [],
-                    'total_amount': 0
-                }
-            
-            # Create a copy of the order without MongoDB-specific fields
-            order_data = {
-                '_id': str(order['_id']),
-                'customer_name': order.get('customer_name'),
-                'item_name': order.get('item_name'),
-                'color': order.get('color'),
-                'quantity': order.get('quantity', 0),
-                'price': order.get('price', 0),
-                'image_url': order.get('image_url'),
-                'subtotal': order.get('price', 0) * order.get('quantity', 0),
-                'status': order.get('status'),
-                'order_group_id': order.get('order_group_id'),
-                'created_at': order.get('created_at').isoformat() if order.get('created_at') else None,
-                'updated_at': order.get('updated_at').isoformat() if order.get('updated_at') else None,
+        groups, next_cursor, paginated = customer_order_groups(
+            {"status": "completed", "sender_id": request.belong_to}
+        )
+
+        def format_group(group):
+            orders = []
+            for order in group['orders']:
+                # Create a copy of the order without MongoDB-specific fields
+                orders.append({
+                    '_id': str(order['_id']),
+                    'customer_name': order.get('customer_name'),
+                    'item_name': order.get('item_name'),
+                    'color': order.get('color'),
+                    'quantity': order.get('quantity', 0),
+                    'price': order.get('price', 0),
+                    'image_url': variant_url(order.get('image_url'), 'thumb'),
+                    'subtotal': order.get('price', 0) * order.get('quantity', 0),
+                    'status': order.get('status'),
+                    'order_group_id': order.get('order_group_id'),
+                    'created_at': order.get('created_at').isoformat() if order.get('created_at') else None,
+                    'updated_at': order.get('updated_at').isoformat() if order.get('updated_at') else None,
+                })
+            return {
+                'customer_name': group.get('customer_name'),
+                'orders': orders,
+                'total_amount': group['total_amount']
             }
-            
-            # Add order to customer's list and update total
-            customer_orders[customer_name]['orders'].append(order_data)
-            customer_orders[customer_name]['total_amount'] += order_data['subtotal']
-        
-        # Convert to list and sort by customer name
-        result = list(customer_orders.values())
-        result.sort(key=lambda x: x['customer_name'])
-        
-        return jsonify(result)
+
+        return customer_page_response(map(format_group, groups), next_cursor, paginated)
     except Exception as e:
         app.logger.error(f'Error fetching history orders: {str(e)}', exc_info=True)
         return jsonify({"error": str(e)}), 500
 
+EXPORT_COLUMNS = [
+    'order_id', 'created_at', 'billing_paid_at', 'customer_name', 'item_name',
+    'color', 'quantity', 'price', 'subtotal', 'status'
+]
+
+def parse_export_date(value, end_of_day=False):
+    """Parse an ISO date or datetime query parameter; bare dates cover the whole day."""
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value)
+    if end_of_day and len(value) == 10:
+        parsed += timedelta(days=1)
+    return parsed
+
+def gzip_stream(chunks):
+    """Gzip-compress a stream of text chunks on the fly."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 writes a gzip header
+    for chunk in chunks:
+        compressed = compressor.compress(chunk.encode('utf-8'))
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+@app.route('/api/orders/export', methods=['GET'])
+@user_id_required
+@owner_required
+def export_orders():
+    """Export completed or billing orders in a date range as CSV or NDJSON.
+
+    Completed orders are filtered on billing_paid_at, billing orders on created_at.
+    """
+    try:
+        export_format = request.args.get('format', 'csv')
+        status = request.args.get('status', 'completed')
+        if export_format not in ('csv', 'ndjson'):
+            return jsonify({"error": "Format must be csv or ndjson"}), 400
+        if status not in ('completed', 'billing'):
+            return jsonify({"error": "Status must be completed or billing"}), 400
+
+        try:
+            start = parse_export_date(request.args.get('from'))
+            end = parse_export_date(request.args.get('to'), end_of_day=True)
+        except ValueError:
+            return jsonify({"error": "Dates must be in ISO format (YYYY-MM-DD)"}), 400
+
+        date_field = 'billing_paid_at' if status == 'completed' else 'created_at'
+        query = {"sender_id": request.belong_to, "status": status}
+        if start or end:
+            query[date_field] = {}
+            if start:
+                query[date_field]['$gte'] = start
+            if end:
+                query[date_field]['$lt'] = end
+
+        # Only the exported fields are read, in batches, in date order
+        orders = orders_collection.find(
+            query,
+            {'customer_name': 1, 'item_name': 1, 'color': 1, 'quantity': 1,
+             'price': 1, 'status': 1, 'created_at': 1, 'billing_paid_at': 1}
+        ).sort(date_field, 1).batch_size(STREAM_BATCH_SIZE)
+
+        def rows():
+            for order in orders:
+                quantity = order.get('quantity', 0)
+                price = order.get('price', 0)
+                yield {
+                    'order_id': str(order['_id']),
+                    'created_at': order['created_at'].isoformat() if order.get('created_at') else None,
+                    'billing_paid_at': order['billing_paid_at'].isoformat() if order.get('billing_paid_at') else None,
+                    'customer_name': order.get('customer_name'),
+                    'item_name': order.get('item_name'),
+                    'color': order.get('color'),
+                    'quantity': quantity,
+                    'price': price,
+                    'subtotal': price * quantity,
+                    'status': order.get('status')
+                }
+
+        def csv_chunks():
+            buffer = io.StringIO()
+            writer = csv.DictWriter(buffer, fieldnames=EXPORT_COLUMNS)
+            writer.writeheader()
+            for i, row in enumerate(rows(), 1):
+                writer.writerow(row)
+                if i % STREAM_BATCH_SIZE == 0:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+            yield buffer.getvalue()
+
+        def ndjson_chunks():
+            batch = []
+            for row in rows():
+                batch.append(json.dumps(row, ensure_ascii=False) + '\n')
+                if len(batch) >= STREAM_BATCH_SIZE:
+                    yield ''.join(batch)
+                    batch = []
+            yield ''.join(batch)
+
+        if export_format == 'csv':
+            chunks = csv_chunks()
+            content_type = 'text/csv; charset=utf-8'
+        else:
+            chunks = ndjson_chunks()
+            content_type = 'application/x-ndjson; charset=utf-8'
+
+        headers = {
+            'Content-Disposition': f'attachment; filename=orders_{status}_{datetime.utcnow().strftime("%Y%m%d")}.{export_format}',
+            # The body depends on Accept-Encoding, so caches must not mix the two forms
+            'Vary': 'Accept-Encoding'
+        }
+        if 'gzip' in request.headers.get('Accept-Encoding', ''):
+            headers['Content-Encoding'] = 'gzip'
+            body = gzip_stream(chunks)
+        else:
+            body = (chunk.encode('utf-8') for chunk in chunks)
+
+        return Response(stream_with_context(body), content_type=content_type, headers=headers)
+
+    except Exception as e:
+        app.logger.error(f'Error exporting orders: {str(e)}', exc_info=True)
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/orders/mark-all-paid', methods=['POST'])
+@user_id_required
 @owner_required
 def mark_all_orders_paid():
-    """Mark all orders for a customer as paid and move them to history."""
+    """Mark all of the seller's billing orders for a customer as paid and move them to history."""
     try:
         data = request.get_json()
         if not data or 'customer_name' not in data:
@@ -1014,34 +2659,23 @@ def mark_all_orders_paid():
 
         customer_name = data['customer_name']
         current_time = datetime.utcnow()
-        
-        # Find all orders for this customer with billing status
-        orders = list(orders_collection.find({
-            "customer_name": customer_name,
-            "status": "billing"
-        }))
-        
-        if not orders:
-            return jsonify({"message": "No orders found to mark as paid"}), 200
 
-        # Update all orders for this customer
-        orders_collection.update_many(
-            {
-                "customer_name": customer_name,
-                "status": "billing"
-            },
-            {
-                "$set": {
-                    "status": "completed",
-                    "billing_status": "paid",
-                    "billing_paid_at": current_time,
-                    "updated_at": current_time
-                }
+        transition = transition_orders(
+            {"customer_name": customer_name, "sender_id": request.belong_to},
+            'billing',
+            'completed',
+            extra_fields={
+                "billing_status": "paid",
+                "billing_paid_at": current_time
             }
         )
 
+        if not transition['count']:
+            return jsonify({"message": "No orders found to mark as paid", **transition}), 200
+
         return jsonify({
-            "message": f"Successfully marked {len(orders)} orders as paid for customer {customer_name}"
+            "message": f"Successfully marked {transition['count']} orders as paid for customer {customer_name}",
+            **transition
         })
 
     except Exception as e:
@@ -1084,6 +2718,8 @@ def update_order_price(order_id):
         if result.modified_count == 0:
             return jsonify({"error": "Failed to update order price"}), 500
 
+        notify_order_change(order.get('sender_id'), 'price_changed', order_ids=[order_id], price=price)
+
         return jsonify({
             "message": "Order price updated successfully",
             "order_id": order_id,
@@ -1142,6 +2778,7 @@ def add_staff():
             {'facebook_id': data['facebook_id']},
             {'$set': {'owner_id': owner_id}}
         )
+        invalidate_identity(data['facebook_id'])
 
         return jsonify({'message': 'Staff added successfully'}), 201
 
@@ -1194,6 +2831,7 @@ def delete_user(staff_id):
 
         # Delete the staff member
         result = users_collection.delete_one({'facebook_id': staff_id})
+        invalidate_identity(staff_id)
         if result.deleted_count == 0:
             return jsonify({'error': 'User not found'}), 404
 
@@ -1294,6 +2932,11 @@ def privacy_policy():
 def serve_static(filename):
     """Serve static files from the static directory."""
     try:
+        if filename.startswith(f"{STORE_SUBDIR}/"):
+            # Content-addressed: a URL always means the same bytes, so it can be cached forever
+            response = send_from_directory(app.static_folder, filename)
+            response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+            return response
         return send_from_directory(app.static_folder, filename)
     except Exception as e:
         app.logger.error(f'Error serving static file {filename}: {str(e)}')
@@ -1305,6 +2948,12 @@ def health_check():
     try:
         # Check MongoDB connection
         users_collection.find_one()
+        if WEBHOOK_QUEUE_ENABLED:
+            # Queued webhooks are only processed while a worker is alive
+            heartbeat_cutoff = datetime.utcnow() - timedelta(seconds=WORKER_HEARTBEAT_TIMEOUT)
+            if not worker_heartbeats_collection.find_one({'seen_at': {'$gte': heartbeat_cutoff}}):
+                app.logger.error('Health check failed: no live webhook worker')
+                return jsonify({"status": "unhealthy", "error": "no live webhook worker"}), 503
         return jsonify({"status": "healthy"}), 200
     except Exception as e:
         app.logger.error(f'Health check failed: {str(e)}')
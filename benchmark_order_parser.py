@@ -0,0 +1,129 @@
+import argparse
+import json
+import logging
+import os
+import statistics
+import time
+
+from dotenv import load_dotenv
+
+from order_parser import canonical, parse_order_message, structured_order_from_lines
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+def load_samples_from_file(path):
+    """Load recorded samples from a JSONL file of {"message", "expected"} objects."""
+    samples = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                record = json.loads(line)
+                samples.append((record['message'], record['expected']))
+    return samples
+
+def load_samples_from_db(limit):
+    """Rebuild recorded LLM outputs from stored messages and the orders the LLM created from them.
+
+    Only orders with parsed_by 'llm' are used: orders the local parser produced
+    would just measure the parser against itself.
+    """
+    from pymongo import MongoClient
+
+    db = MongoClient(os.getenv('MONGO_URI')).facebook_messages
+    groups = db.orders.aggregate([
+        {'$match': {'parsed_by': 'llm', 'message_id': {'$ne': None}}},
+        {'$sort': {'_id': 1}},
+        {'$group': {
+            '_id': '$message_id',
+            'created_at': {'$first': '$created_at'},
+            'orders': {'$push': {
+                'item_name': '$item_name',
+                'customer_name': '$customer_name',
+                'color': '$color',
+                'quantity': '$quantity'
+            }}
+        }},
+        {'$sort': {'created_at': -1}},
+        {'$limit': limit}
+    ])
+    orders_by_message = {group['_id']: group['orders'] for group in groups}
+
+    samples = []
+    for message in db.messages.find({'_id': {'$in': list(orders_by_message)}}, {'message': 1}):
+        expected = structured_order_from_lines(orders_by_message[message['_id']])
+        samples.append((message['message'], expected))
+    return samples
+
+def time_llm(samples):
+    """Time live LLM parses for comparison (costs API calls)."""
+    from app import parse_order_with_llm
+
+    timings = []
+    for message, _ in samples:
+        start = time.perf_counter()
+        parse_order_with_llm(message)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+def run_benchmark(samples, threshold, repeat, llm_sample):
+    """Report local parser latency, coverage and agreement with the recorded outputs."""
+    timings = []
+    covered = 0
+    agreed = 0
+    disagreements = []
+
+    for message, expected in samples:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            structured_order, confidence = parse_order_message(message)
+            timings.append(time.perf_counter() - start)
+
+        if structured_order and confidence >= threshold:
+            covered += 1
+            if canonical(structured_order) == canonical(expected):
+                agreed += 1
+            else:
+                disagreements.append((message, structured_order, expected))
+
+    timings_us = sorted(t * 1e6 for t in timings)
+    logger.info(f"Samples: {len(samples)}")
+    logger.info(
+        f"Local parser latency: mean {statistics.mean(timings_us):.1f}us, "
+        f"p50 {timings_us[len(timings_us) // 2]:.1f}us, "
+        f"p99 {timings_us[int(len(timings_us) * 0.99)]:.1f}us"
+    )
+    logger.info(f"Handled locally (confidence >= {threshold}): {covered}/{len(samples)} ({covered / len(samples):.1%})")
+    if covered:
+        logger.info(f"Agreement with recorded LLM output: {agreed}/{covered} ({agreed / covered:.1%})")
+    for message, got, expected in disagreements[:10]:
+        logger.info(f"Mismatch: {message!r}\n  local: {got}\n  llm:   {expected}")
+
+    if llm_sample:
+        llm_timings_ms = sorted(t * 1e3 for t in time_llm(samples[:llm_sample]))
+        logger.info(
+            f"LLM latency over {len(llm_timings_ms)} calls: mean {statistics.mean(llm_timings_ms):.0f}ms, "
+            f"p50 {llm_timings_ms[len(llm_timings_ms) // 2]:.0f}ms"
+        )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the local order parser against recorded LLM outputs.")
+    parser.add_argument('--file', help="JSONL file of {\"message\", \"expected\"} records (default: rebuild from MongoDB)")
+    parser.add_argument('--limit', type=int, default=1000, help="Maximum number of messages to read from MongoDB")
+    parser.add_argument('--threshold', type=float, default=float(os.getenv('ORDER_PARSER_MIN_CONFIDENCE', 0.9)))
+    parser.add_argument('--repeat', type=int, default=100, help="Parses per message when timing")
+    parser.add_argument('--llm-sample', type=int, default=0, help="Also time this many live LLM calls")
+    args = parser.parse_args()
+
+    samples = load_samples_from_file(args.file) if args.file else load_samples_from_db(args.limit)
+    if not samples:
+        logger.error("No samples found")
+    else:
+        run_benchmark(samples, args.threshold, args.repeat, args.llm_sample)
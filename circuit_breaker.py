@@ -0,0 +1,99 @@
+"""Circuit breaker for calls to a slow or failing external service."""
+import threading
+import time
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the service while the breaker is open."""
+
+
+class CircuitBreaker:
+    """Fail fast after repeated errors or slow calls, then probe with one trial call.
+
+    States are 'closed' (calls go through), 'open' (calls raise CircuitOpenError
+    until reset_timeout has passed) and 'half_open' (a single trial call decides
+    whether to close again or re-open). Calls slower than slow_call_threshold
+    count as failures even though their result is returned; pass None when the
+    caller enforces its own deadline. Exceptions listed in ignored_exceptions
+    (e.g. unusable replies from a healthy service) count as successes, those in
+    neutral_exceptions (e.g. no local capacity to make the call) as neither.
+    """
+
+    def __init__(self, failure_threshold=5, slow_call_threshold=10, reset_timeout=30,
+                 ignored_exceptions=(), neutral_exceptions=(), on_close=None):
+        self.failure_threshold = failure_threshold
+        self.slow_call_threshold = slow_call_threshold  # seconds, or None to not time calls
+        self.reset_timeout = reset_timeout  # seconds
+        self.ignored_exceptions = ignored_exceptions
+        self.neutral_exceptions = neutral_exceptions
+        self.on_close = on_close
+        self.opened_count = 0
+        self.rejected_count = 0
+        self._state = 'closed'
+        self._consecutive_failures = 0
+        self._opened_at = 0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        return self._state
+
+    def _before_call(self):
+        with self._lock:
+            if self._state == 'open' and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._state = 'half_open'
+            if self._state == 'open' or (self._state == 'half_open' and self._trial_in_flight):
+                self.rejected_count += 1
+                raise CircuitOpenError('Circuit breaker is open')
+            if self._state == 'half_open':
+                self._trial_in_flight = True
+
+    def _record(self, success):
+        closed = False
+        with self._lock:
+            self._trial_in_flight = False
+            if success is None:
+                # Says nothing about the service; a half-open breaker lets the next call try
+                pass
+            elif success:
+                self._consecutive_failures = 0
+                closed = self._state != 'closed'
+                self._state = 'closed'
+            else:
+                self._consecutive_failures += 1
+                if self._state == 'half_open' or self._consecutive_failures >= self.failure_threshold:
+                    if self._state != 'open':
+                        self.opened_count += 1
+                    self._state = 'open'
+                    self._opened_at = time.monotonic()
+
+        if closed and self.on_close:
+            self.on_close()
+
+    def call(self, func, *args, **kwargs):
+        """Call func through the breaker, raising CircuitOpenError while it is open."""
+        self._before_call()
+        start = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except self.neutral_exceptions:
+            self._record(None)
+            raise
+        except self.ignored_exceptions:
+            self._record(True)
+            raise
+        except Exception:
+            self._record(False)
+            raise
+        self._record(self.slow_call_threshold is None or time.monotonic() - start <= self.slow_call_threshold)
+        return result
+
+    def stats(self):
+        """Return the current state and counters."""
+        return {
+            'state': self._state,
+            'consecutive_failures': self._consecutive_failures,
+            'opened_count': self.opened_count,
+            'rejected_count': self.rejected_count
+        }
@@ -21,6 +21,7 @@ def clear_database():
         collections = [
             'messages',
             'orders',
+            'order_summaries',
             'products',
             'users'
         ]
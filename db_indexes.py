@@ -0,0 +1,247 @@
+import argparse
+import logging
+import sys
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+from app import (
+    ensure_indexes,
+    llm_usage_collection,
+    messages_collection,
+    order_summaries_collection,
+    order_transitions_collection,
+    orders_collection,
+    parse_cache_collection,
+    products_collection,
+    users_collection,
+    webhook_queue_collection
+)
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+SAMPLE_SENDER = 'audit_sender'
+SAMPLE_USER = 'audit_user'
+
+# Indexes no query uses any more, dropped by 'create': (collection, index name)
+OBSOLETE_INDEXES = [
+    # transition_orders reads its batch back through the index of its own query
+    (orders_collection, 'transition_id_1'),
+    # order_transitions is an audit log that no endpoint reads
+    (order_transitions_collection, 'created_at_-1'),
+]
+
+def endpoint_queries():
+    """Representative queries issued by the endpoints: (name, collection, kind, query, sort)."""
+    now = datetime.utcnow()
+    return [
+        ('user_id_required', users_collection, 'find', {'facebook_id': SAMPLE_USER}, None),
+        ('get_messages', messages_collection, 'find', {}, [('timestamp', -1)]),
+        ('get_messages by conversation', messages_collection, 'find',
+         {'conversation_id': 'audit_conversation'}, [('timestamp', -1)]),
+        ('store_message', messages_collection, 'find', {'message_id': 'audit_mid'}, None),
+        ('handle_attachments', messages_collection, 'find', {
+            'sender_id': SAMPLE_SENDER,
+            'created_at': {'$gte': now - timedelta(minutes=5)},
+            'message': {'$exists': True, '$ne': ''}
+        }, [('created_at', -1)]),
+        ('handle_text_message', orders_collection, 'find',
+         {'sender_id': SAMPLE_SENDER, 'customer_name_status': 'pending'}, None),
+        ('insert_product', products_collection, 'find', {'name_lower': 'audit product'}, None),
+        ('get_orders', orders_collection, 'find', {'sender_id': SAMPLE_SENDER}, None),
+        ('aggregate_order_summaries', orders_collection, 'aggregate', [
+            {'$match': {'status': 'pickup', 'sender_id': SAMPLE_SENDER}},
+            {'$facet': {
+                'image_orders': [{'$match': {'item_name': {'$regex': '^Image Order'}}}],
+                'products': [{'$match': {'item_name': {'$not': {'$regex': '^Image Order'}}}}]
+            }}
+        ], None),
+        ('read_order_summaries', order_summaries_collection, 'find',
+         {'sender_id': SAMPLE_SENDER, 'quantity': {'$gt': 0}}, None),
+        ('get_preparing_orders', orders_collection, 'find',
+         {'status': 'preparing', 'sender_id': SAMPLE_SENDER}, None),
+        ('get_billing_orders', orders_collection, 'find', {'status': 'billing'}, None),
+        ('get_history_orders', orders_collection, 'find',
+         {'status': 'completed', 'sender_id': SAMPLE_SENDER}, None),
+        ('customer_order_groups page customers', orders_collection, 'find',
+         {'status': 'preparing', 'sender_id': SAMPLE_SENDER, 'customer_name': {'$gt': 'Audit Customer'}},
+         [('customer_name', 1)]),
+        ('customer_order_groups billing page customers', orders_collection, 'find',
+         {'status': 'billing', 'customer_name': {'$gt': 'Audit Customer'}}, [('customer_name', 1)]),
+        ('customer_order_groups page orders', orders_collection, 'aggregate', [
+            {'$match': {'status': 'completed', 'sender_id': SAMPLE_SENDER,
+                        'customer_name': {'$in': ['Audit Customer', 'Other Customer']}}},
+            {'$sort': {'customer_name': 1, 'created_at': 1}}
+        ], None),
+        ('export_orders completed', orders_collection, 'find', {
+            'sender_id': SAMPLE_SENDER,
+            'status': 'completed',
+            'billing_paid_at': {'$gte': now - timedelta(days=30), '$lt': now}
+        }, [('billing_paid_at', 1)]),
+        ('export_orders billing', orders_collection, 'find', {
+            'sender_id': SAMPLE_SENDER,
+            'status': 'billing',
+            'created_at': {'$gte': now - timedelta(days=30), '$lt': now}
+        }, [('created_at', 1)]),
+        ('move_orders_to_billing by ids', orders_collection, 'find',
+         {'_id': {'$in': [ObjectId(), ObjectId()]}, 'sender_id': SAMPLE_SENDER, 'status': 'preparing'}, None),
+        ('move_orders_to_billing by customer', orders_collection, 'find',
+         {'customer_name': 'Audit Customer', 'sender_id': SAMPLE_SENDER, 'status': 'preparing'}, None),
+        ('move_orders_to_preparing', orders_collection, 'find',
+         {'item_name': 'Audit Product', 'sender_id': SAMPLE_SENDER, 'status': 'pickup'}, None),
+        ('mark_all_orders_paid', orders_collection, 'find',
+         {'customer_name': 'Audit Customer', 'sender_id': SAMPLE_SENDER, 'status': 'billing'}, None),
+        ('propagate_product_change', orders_collection, 'find',
+         {'item_name': 'Audit Product', 'status': {'$in': ['pickup', 'preparing', 'billing']}}, None),
+        ('propagate_pending_product_changes', products_collection, 'find', {'propagation_pending': True}, None),
+        ('transition_orders read-back', orders_collection, 'find', {
+            'item_name': 'Audit Product',
+            'sender_id': SAMPLE_SENDER,
+            'status': 'preparing',
+            'transition_id': ObjectId()
+        }, None),
+        ('replace_message_orders', orders_collection, 'find', {'message_id': ObjectId()}, None),
+        ('reprocess_pending_parses', messages_collection, 'find',
+         {'parse_status': 'pending'}, [('parse_pending_at', 1)]),
+        ('mirror_pending_order_images', orders_collection, 'find', {'$or': [
+            {'image_fetch_status': 'pending'},
+            {'image_fetch_status': 'fetching', 'image_fetch_lease_until': {'$lt': now}}
+        ]}, [('created_at', 1)]),
+        ('parse_order_with_cache', parse_cache_collection, 'find',
+         {'key': 'audit_key', 'expires_at': {'$gt': now}}, None),
+        ('get_llm_usage', llm_usage_collection, 'aggregate',
+         [{'$match': {'created_at': {'$gte': now - timedelta(days=7)}}}], None),
+        ('webhook_worker claim_job', webhook_queue_collection, 'find',
+         {'status': {'$in': ['pending', 'processing']}, 'available_at': {'$lte': now}},
+         [('available_at', 1)]),
+    ]
+
+def drop_obsolete_indexes():
+    """Drop the OBSOLETE_INDEXES that still exist; returns their names."""
+    dropped = []
+    for collection, name in OBSOLETE_INDEXES:
+        if name in collection.index_information():
+            collection.drop_index(name)
+            dropped.append(f"{collection.name}.{name}")
+    return dropped
+
+def dedup_messages():
+    """Detach duplicate messages sharing a Meta mid so the unique message_id index can be built.
+
+    The first processed copy (or the oldest) keeps message_id. The others move it
+    to duplicate_message_id and point at the kept copy through duplicate_of.
+    Nothing is deleted, and orders created from the duplicates are left alone.
+    Returns the number of detached messages.
+    """
+    groups = messages_collection.aggregate([
+        {'$match': {'message_id': {'$type': 'string'}}},
+        {'$group': {'_id': '$message_id', 'ids': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}}
+    ], allowDiskUse=True)
+
+    detached = 0
+    for group in groups:
+        copies = list(messages_collection.find(
+            {'_id': {'$in': group['ids']}},
+            {'processed_at': 1}
+        ).sort('_id', 1))
+        keeper = next((copy for copy in copies if copy.get('processed_at')), copies[0])
+        duplicate_ids = [copy['_id'] for copy in copies if copy['_id'] != keeper['_id']]
+        messages_collection.update_many(
+            {'_id': {'$in': duplicate_ids}},
+            {
+                '$set': {'duplicate_message_id': group['_id'], 'duplicate_of': keeper['_id']},
+                '$unset': {'message_id': ''}
+            }
+        )
+        order_count = orders_collection.count_documents({'message_id': {'$in': duplicate_ids}})
+        if order_count:
+            logger.warning(f"mid {group['_id']}: {len(duplicate_ids)} duplicate messages created {order_count} orders, review them")
+        detached += len(duplicate_ids)
+    return detached
+
+def explain(collection, kind, query, sort):
+    """Return the explain output of a find or aggregate query."""
+    if kind == 'aggregate':
+        return collection.database.command(
+            'aggregate', collection.name, pipeline=query, explain=True
+        )
+    cursor = collection.find(query)
+    if sort:
+        cursor = cursor.sort(sort)
+    return cursor.explain()
+
+def plan_stages(plan):
+    """Yield every stage name found anywhere in an explain document."""
+    if isinstance(plan, dict):
+        for key, value in plan.items():
+            if key == 'stage' and isinstance(value, str):
+                yield value
+            else:
+                yield from plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from plan_stages(value)
+
+def winning_plans(explain_output):
+    """Return only the winning plans, so rejected COLLSCAN candidates are ignored."""
+    plans = []
+
+    def collect(node):
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if key == 'winningPlan':
+                    plans.append(value)
+                else:
+                    collect(value)
+        elif isinstance(node, list):
+            for value in node:
+                collect(value)
+
+    collect(explain_output)
+    return plans
+
+def audit_query_plans():
+    """Explain every endpoint query and return the names of those doing a COLLSCAN."""
+    collscans = []
+    for name, collection, kind, query, sort in endpoint_queries():
+        stages = set()
+        for plan in winning_plans(explain(collection, kind, query, sort)):
+            stages.update(plan_stages(plan))
+
+        if 'COLLSCAN' in stages:
+            collscans.append(name)
+            logger.error(f"{name}: COLLSCAN on {collection.name} ({', '.join(sorted(stages))})")
+        else:
+            logger.info(f"{name}: {', '.join(sorted(stages)) or 'no plan'}")
+    return collscans
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create MongoDB indexes and audit endpoint query plans.")
+    parser.add_argument('command', choices=['create', 'audit', 'dedup-messages'])
+    args = parser.parse_args()
+
+    if args.command == 'create':
+        for name in drop_obsolete_indexes():
+            logger.info(f"Dropped unused index {name}")
+        failed = ensure_indexes()
+        if failed:
+            logger.error(f"Failed to create indexes: {', '.join(failed)}")
+            if 'messages.message_id' in failed:
+                logger.error("Duplicate message mids block the unique message_id index; run 'python db_indexes.py dedup-messages' first")
+            sys.exit(1)
+        logger.info("Indexes created successfully")
+    elif args.command == 'dedup-messages':
+        detached = dedup_messages()
+        logger.info(f"Detached {detached} duplicate messages")
+    else:
+        collscans = audit_query_plans()
+        if collscans:
+            logger.error(f"{len(collscans)} queries do a COLLSCAN: {', '.join(collscans)}")
+            sys.exit(1)
+        logger.info("No endpoint query does a COLLSCAN")
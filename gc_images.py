@@ -0,0 +1,89 @@
+import argparse
+import logging
+from datetime import datetime, timedelta
+
+from app import app, image_blobs_collection, orders_collection, products_collection
+from image_store import delete_image_files
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+def is_referenced(digest):
+    """Return True if a product or an order still uses the stored image (indexed lookups)."""
+    return any(
+        collection.find_one({'image_digest': digest}, {'_id': 1}) is not None
+        for collection in (products_collection, orders_collection)
+    )
+
+def claim_for_deletion(blob):
+    """Mark an unreferenced image as being deleted; returns False if it was retained or leased meanwhile.
+
+    lease_image waits while the mark is set, so nothing can reuse the files
+    between their deletion and the removal of the record.
+    """
+    now = datetime.utcnow()
+    return image_blobs_collection.update_one(
+        {
+            '_id': blob['_id'],
+            'ref_count': {'$lte': 0},
+            'deleting': {'$ne': True},
+            '$or': [{'lease_until': {'$exists': False}}, {'lease_until': {'$lt': now}}]
+        },
+        {'$set': {'deleting': True, 'deleting_at': now}}
+    ).modified_count == 1
+
+def delete_image(blob):
+    """Delete the files of an image claimed for deletion, then its record."""
+    removed = delete_image_files(app.static_folder, blob['digest'])
+    image_blobs_collection.delete_one({'_id': blob['_id']})
+    logger.info(f"Deleted image {blob['digest']} ({removed} files)")
+
+def collect_garbage(grace_hours=24, dry_run=False):
+    """Delete stored images nothing has referenced for grace_hours; returns how many were deleted."""
+    now = datetime.utcnow()
+    cutoff = now - timedelta(hours=grace_hours)
+
+    deleted = 0
+    if not dry_run:
+        # Finish deletions an earlier run left half done
+        for blob in image_blobs_collection.find({'deleting': True, 'deleting_at': {'$lt': now - timedelta(minutes=10)}}):
+            delete_image(blob)
+            deleted += 1
+
+    candidates = list(image_blobs_collection.find({
+        'ref_count': {'$lte': 0},
+        'updated_at': {'$lt': cutoff},
+        'deleting': {'$ne': True}
+    }))
+    if not candidates:
+        return deleted
+
+    # Orders keep the image they were created with, so check them as well as the counts
+    for blob in candidates:
+        digest = blob['digest']
+        if is_referenced(digest):
+            logger.warning(f"Image {digest} has ref_count {blob['ref_count']} but is still referenced; keeping it")
+            continue
+        if dry_run:
+            logger.info(f"Would delete image {digest} ({blob.get('path')})")
+            deleted += 1
+            continue
+
+        # Claim the record first; an upload or download that reuses the image retains or leases it
+        if claim_for_deletion(blob):
+            delete_image(blob)
+            deleted += 1
+    return deleted
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Delete stored images that are no longer referenced.")
+    parser.add_argument('--grace-hours', type=int, default=24, help="Keep unreferenced images at least this long")
+    parser.add_argument('--dry-run', action='store_true', help="Only list the images that would be deleted")
+    args = parser.parse_args()
+
+    count = collect_garbage(args.grace_hours, args.dry_run)
+    logger.info(f"{'Would delete' if args.dry_run else 'Deleted'} {count} unreferenced images")
@@ -0,0 +1,265 @@
+"""Content-addressed storage for images.
+
+Images are stored once per SHA-256 of their original bytes, under
+static/images/<first two hex digits>/<digest>..., so a picture that is
+downloaded or uploaded again reuses the files already on disk. With Pillow the
+stored files are the image_variants sizes (<digest>_full.webp, ...); without it
+the original bytes are kept as <digest>.<ext>. Uploads and downloads are first
+written to a temporary directory outside the served static folder.
+
+ImageFetcher mirrors remote images (Messenger attachment URLs) into the store
+on a bounded thread pool sharing one pooled HTTP session.
+"""
+import errno
+import hashlib
+import logging
+import os
+import re
+import shutil
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from image_variants import FORMATS, VARIANTS, create_variants, variants_available
+
+logger = logging.getLogger(__name__)
+
+STORE_SUBDIR = 'images'
+CHUNK_SIZE = 64 * 1024
+
+# Leading bytes of the image types accepted into the store
+_MAGIC_NUMBERS = [
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+]
+
+# Store URLs: /static/images/<aa>/<digest>[_<variant>].<ext>
+_STORED_URL_RE = re.compile(r'/static/%s/[0-9a-f]{2}/([0-9a-f]{64})(?:_[a-z]+)?\.[a-z]+$' % STORE_SUBDIR)
+
+
+class ImageTooLarge(Exception):
+    """Raised when an image is bigger than the allowed size."""
+
+
+def sniff_image_type(head):
+    """Return the file extension for the image type in the first bytes of a file, or None."""
+    for magic, extension in _MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return extension
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+class HashingFile:
+    """Temporary file in dest_dir that hashes, measures and sniffs everything written to it.
+
+    Used as the werkzeug stream for uploaded files, so an upload is written to
+    disk in chunks and hashed in the same pass. The file is deleted on close()
+    unless detach() handed it over first.
+    """
+
+    HEAD_SIZE = 16
+
+    def __init__(self, dest_dir, max_bytes=None):
+        os.makedirs(dest_dir, exist_ok=True)
+        self.path = os.path.join(dest_dir, f".{uuid.uuid4().hex}.part")
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.head = b''
+        self._digest = hashlib.sha256()
+        self._file = open(self.path, 'w+b')
+
+    def write(self, data):
+        self.size += len(data)
+        if self.max_bytes and self.size > self.max_bytes:
+            self.close()
+            raise ImageTooLarge(f"Image is larger than {self.max_bytes} bytes")
+        if len(self.head) < self.HEAD_SIZE:
+            self.head += bytes(data[:self.HEAD_SIZE - len(self.head)])
+        self._digest.update(data)
+        return self._file.write(data)
+
+    @property
+    def hexdigest(self):
+        return self._digest.hexdigest()
+
+    def detach(self):
+        """Close the file and return its path; the caller becomes responsible for it."""
+        self._file.close()
+        path, self.path = self.path, None
+        return path
+
+    def close(self):
+        self._file.close()
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+        self.path = None
+
+    def __getattr__(self, name):
+        # read, seek, tell, flush... go to the underlying file
+        if name == '_file':
+            raise AttributeError(name)
+        return getattr(self._file, name)
+
+
+def write_chunks(chunks, dest_dir, max_bytes=None):
+    """Write byte chunks to a temporary file in dest_dir, hashing them in the same pass.
+
+    Returns (temporary path, hex SHA-256, size). Raises ImageTooLarge as soon as
+    more than max_bytes have been read, removing the partial file.
+    """
+    upload = HashingFile(dest_dir, max_bytes)
+    try:
+        for chunk in chunks:
+            if chunk:
+                upload.write(chunk)
+    except BaseException:
+        upload.close()
+        raise
+    return upload.detach(), upload.hexdigest, upload.size
+
+
+def _move_into_place(tmp_path, path):
+    """Move a file to path atomically, copying it first when it is on another filesystem."""
+    try:
+        os.replace(tmp_path, path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        staging = os.path.join(os.path.dirname(path), f".{uuid.uuid4().hex}.part")
+        try:
+            shutil.copyfile(tmp_path, staging)
+            os.replace(staging, path)
+        finally:
+            if os.path.exists(staging):
+                os.remove(staging)
+
+
+def store_image_file(tmp_path, digest, static_folder, image_format='webp'):
+    """Move a hashed temporary file into the store and return its path relative to static_folder.
+
+    If an image with the same digest is already stored, its files are reused.
+    The temporary file is always removed.
+    """
+    directory = os.path.join(static_folder, STORE_SUBDIR, digest[:2])
+    os.makedirs(directory, exist_ok=True)
+    try:
+        if variants_available():
+            extension = FORMATS[image_format][1]
+            filename = f"{digest}_full.{extension}"
+            stored = all(
+                os.path.exists(os.path.join(directory, f"{digest}_{variant}.{extension}"))
+                for variant in VARIANTS
+            )
+            if not stored:
+                # Write under a unique name, then rename, so readers never see partial files.
+                # The full variant goes last: it is the URL handed out, so it only appears
+                # once the other sizes exist, and a crash before then is redone next time.
+                tmp_base = f".{digest}.{uuid.uuid4().hex}"
+                tmp_names = create_variants(tmp_path, directory, tmp_base, image_format)
+                for variant in sorted(tmp_names, key=lambda name: name == 'full'):
+                    os.replace(
+                        os.path.join(directory, tmp_names[variant]),
+                        os.path.join(directory, f"{digest}_{variant}.{extension}")
+                    )
+        else:
+            with open(tmp_path, 'rb') as f:
+                extension = sniff_image_type(f.read(16))
+            if not extension:
+                raise ValueError("File is not a supported image")
+            filename = f"{digest}.{extension}"
+            if not os.path.exists(os.path.join(directory, filename)):
+                _move_into_place(tmp_path, os.path.join(directory, filename))
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return f"{STORE_SUBDIR}/{digest[:2]}/{filename}"
+
+
+def stored_image_digest(image_url):
+    """Return the digest of a URL pointing into the store, or None for any other URL."""
+    match = _STORED_URL_RE.search(image_url or '')
+    return match.group(1) if match else None
+
+
+def delete_image_files(static_folder, digest):
+    """Remove every stored file (all variants) of a digest; returns how many were removed."""
+    directory = os.path.join(static_folder, STORE_SUBDIR, digest[:2])
+    if not os.path.isdir(directory):
+        return 0
+    removed = 0
+    for filename in os.listdir(directory):
+        if filename.startswith(digest):
+            os.remove(os.path.join(directory, filename))
+            removed += 1
+    return removed
+
+
+class ImageFetcher:
+    """Download remote images into the store on a bounded pool of threads."""
+
+    def __init__(self, static_folder, tmp_dir, image_format='webp', workers=4, max_pending=200,
+                 timeout=15, max_bytes=20 * 1024 * 1024):
+        self.static_folder = static_folder
+        self.tmp_dir = tmp_dir
+        self.image_format = image_format
+        self.timeout = timeout  # seconds
+        self.max_bytes = max_bytes
+        self.session = requests.Session()
+        # One connection pool shared by every worker, retrying transient CDN errors
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=workers,
+            max_retries=Retry(total=2, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='image-fetch')
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def download(self, url, before_store=None):
+        """Download an image into the store and return its path relative to the static folder.
+
+        before_store(digest), if given, runs once the content hash is known and
+        before the files are stored or reused.
+        """
+        with self.session.get(url, stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            if not response.headers.get('Content-Type', '').startswith('image/'):
+                raise ValueError(f"Not an image: {response.headers.get('Content-Type')}")
+            tmp_path, digest, _ = write_chunks(
+                response.iter_content(CHUNK_SIZE),
+                self.tmp_dir,
+                self.max_bytes
+            )
+        try:
+            if before_store:
+                before_store(digest)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return store_image_file(tmp_path, digest, self.static_folder, self.image_format)
+
+    def submit(self, func, *args):
+        """Run func(*args) on the pool; returns False without queueing if the pool is saturated."""
+        if not self._slots.acquire(blocking=False):
+            return False
+        try:
+            future = self._executor.submit(func, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(self._finished)
+        return True
+
+    def _finished(self, future):
+        self._slots.release()
+        if future.exception():
+            logger.error(f"Image fetch job failed: {future.exception()}")
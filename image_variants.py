@@ -0,0 +1,70 @@
+"""Resized, metadata-free variants of product and order images.
+
+Every image is re-encoded into a fixed set of sizes saved as
+<base>_<variant>.<ext>. Only the 'full' URL is stored on products and orders;
+variant_url() derives the smaller ones, so each response can point at the size
+it actually displays.
+
+Pillow is optional: without it uploads are stored unchanged.
+"""
+import os
+import re
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# Longest side in pixels; variants never upscale
+VARIANTS = {'full': 1600, 'card': 480, 'thumb': 160}
+
+# (Pillow format, file extension, save options)
+FORMATS = {
+    'webp': ('WEBP', 'webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', 'jpg', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+_VARIANT_RE = re.compile(r'_(?:%s)\.(webp|jpg)$' % '|'.join(VARIANTS))
+
+
+def variants_available():
+    """Return True if Pillow is installed and variants can be created."""
+    return Image is not None
+
+
+def create_variants(source, dest_dir, base_name, image_format='webp'):
+    """Write every variant of the image in source (a path or file object).
+
+    Returns {variant: filename}. Raises PIL.UnidentifiedImageError if source is
+    not an image Pillow can read.
+    """
+    pil_format, extension, options = FORMATS[image_format]
+    largest = max(VARIANTS.values())
+
+    with Image.open(source) as original:
+        # JPEG decoders can downscale while decoding, which is much cheaper
+        original.draft('RGB', (largest, largest))
+        # Apply the EXIF orientation now; EXIF and other metadata are not written back
+        image = ImageOps.exif_transpose(original)
+        has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+        if has_alpha and pil_format == 'JPEG':
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+
+        filenames = {}
+        # Largest first, so each variant is downscaled from the previous one
+        for variant, size in sorted(VARIANTS.items(), key=lambda item: item[1], reverse=True):
+            image.thumbnail((size, size), Image.LANCZOS)
+            filename = f"{base_name}_{variant}.{extension}"
+            image.save(os.path.join(dest_dir, filename), pil_format, **options)
+            filenames[variant] = filename
+    return filenames
+
+
+def variant_url(image_url, variant):
+    """Return the URL of another size of a variant image; other URLs are returned unchanged."""
+    if not image_url:
+        return image_url
+    return _VARIANT_RE.sub(lambda match: f"_{variant}.{match.group(1)}", image_url)
@@ -0,0 +1,201 @@
+import argparse
+import logging
+import os
+from datetime import datetime
+
+from bson import ObjectId
+
+from app import (
+    ORDER_PARSER_MIN_CONFIDENCE,
+    LLMOutputTruncated,
+    cached_parse,
+    llm_batches_collection,
+    messages_collection,
+    order_line_count,
+    order_parse_request,
+    orders_collection,
+    record_llm_usage,
+    save_structured_order,
+    store_parsed_order,
+    structured_order_from_response
+)
+from llm_client import batch_results, retrieve_batch, submit_batch
+from order_parser import parse_order_message
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+
+# Batch API states after which no more results will arrive
+FINISHED_STATES = {'completed', 'failed', 'expired', 'cancelled'}
+
+def has_orders(message_id):
+    """Return True if any order was created from the message (uses the orders message_id index)."""
+    return orders_collection.find_one({'message_id': message_id}, {'_id': 1}) is not None
+
+def pending_messages(since=None, until=None, limit=None):
+    """Stored order-length text messages that produced no orders and are not in a batch yet.
+
+    "No orders" is checked against the orders collection rather than the
+    message's order_count, which messages stored before it existed do not have.
+    Messages an earlier batch parsed to no orders, or failed on, have an
+    llm_batch_status and are not sent again.
+    """
+    query = {
+        'message': {'$exists': True, '$ne': ''},
+        'llm_batch_id': {'$exists': False},
+        'llm_batch_status': {'$exists': False}
+    }
+    if since or until:
+        query['created_at'] = {}
+        if since:
+            query['created_at']['$gte'] = since
+        if until:
+            query['created_at']['$lt'] = until
+
+    cursor = messages_collection.find(query, {'message': 1, 'sender_id': 1}).sort('created_at', 1)
+    count = 0
+    for message in cursor:
+        if len(message['message'].split()) < 4 or has_orders(message['_id']):
+            continue
+        yield message
+        count += 1
+        if limit and count >= limit:
+            return
+
+def mark_batch_status(message_id, status):
+    """Record why a message left the backfill for good: 'no_orders' or 'failed'."""
+    messages_collection.update_one({'_id': message_id}, {'$set': {'llm_batch_status': status}})
+
+def save_llm_order(structured_order, message):
+    """Create the orders of an LLM parse, or mark the message 'no_orders' if it has none."""
+    if order_line_count(structured_order):
+        save_structured_order(structured_order, message['_id'], message['sender_id'], 'llm')
+    else:
+        mark_batch_status(message['_id'], 'no_orders')
+
+def submit(since=None, until=None, limit=None):
+    """Parse what the local parser and the parse cache can and send the rest as one Batch API job."""
+    requests = []
+    local_count = 0
+    cached_count = 0
+    for message in pending_messages(since, until, limit):
+        structured_order, confidence = parse_order_message(message['message'])
+        if structured_order and confidence >= ORDER_PARSER_MIN_CONFIDENCE:
+            save_structured_order(structured_order, message['_id'], message['sender_id'], 'local')
+            local_count += 1
+            continue
+
+        # An identical message was already parsed by the LLM
+        structured_order = cached_parse(message['message'])
+        if structured_order is not None:
+            save_llm_order(structured_order, message)
+            cached_count += 1
+            continue
+
+        requests.append((str(message['_id']), order_parse_request(message['message'])))
+
+    logger.info(f"Parsed {local_count} messages locally, {cached_count} from the parse cache")
+    if not requests:
+        logger.info("No messages left for the Batch API")
+        return None
+
+    batch = submit_batch(OPENAI_API_KEY, requests, metadata={'purpose': 'order_parse_backfill'})
+    message_ids = [ObjectId(custom_id) for custom_id, _ in requests]
+    llm_batches_collection.insert_one({
+        'batch_id': batch.id,
+        'status': batch.status,
+        'message_count': len(message_ids),
+        'created_at': datetime.utcnow()
+    })
+    messages_collection.update_many({'_id': {'$in': message_ids}}, {'$set': {'llm_batch_id': batch.id}})
+    logger.info(f"Submitted batch {batch.id} with {len(message_ids)} messages")
+    return batch.id
+
+def apply_results(batch):
+    """Create orders from a finished batch; returns (saved, failed) message counts."""
+    saved = 0
+    failed = 0
+    for custom_id, body, error in batch_results(OPENAI_API_KEY, batch):
+        message_id = ObjectId(custom_id)
+        # Skip messages that got their orders some other way since submission
+        message = messages_collection.find_one({'_id': message_id})
+        if not message or has_orders(message_id):
+            continue
+
+        try:
+            if error:
+                raise ValueError(error)
+            choice = body['choices'][0]
+            if choice.get('finish_reason') == 'length':
+                raise LLMOutputTruncated('LLM output was cut off by max_tokens')
+            structured_order = structured_order_from_response(choice['message'])
+            record_llm_usage(body.get('usage') or {}, structured_order, mode='batch')
+            store_parsed_order(message['message'], structured_order)
+            save_llm_order(structured_order, message)
+            saved += 1
+        except LLMOutputTruncated as e:
+            # Too many lines for the output budget: keep the local parse if there is one
+            structured_order, _ = parse_order_message(message['message'])
+            if structured_order and order_line_count(structured_order):
+                logger.warning(f"Batch result for message {custom_id}: {str(e)}, keeping the local parse")
+                save_structured_order(structured_order, message_id, message['sender_id'], 'local')
+                saved += 1
+            else:
+                logger.error(f"Batch result for message {custom_id} not applied: {str(e)}")
+                mark_batch_status(message_id, 'failed')
+                failed += 1
+        except Exception as e:
+            logger.error(f"Batch result for message {custom_id} not applied: {str(e)}")
+            mark_batch_status(message_id, 'failed')
+            failed += 1
+    return saved, failed
+
+def collect():
+    """Check every open batch and apply the results of those that have finished."""
+    for record in llm_batches_collection.find({'status': {'$nin': ['collected']}}):
+        batch = retrieve_batch(OPENAI_API_KEY, record['batch_id'])
+        if batch.status not in FINISHED_STATES:
+            llm_batches_collection.update_one({'_id': record['_id']}, {'$set': {'status': batch.status}})
+            logger.info(f"Batch {batch.id}: {batch.status}")
+            continue
+
+        saved, failed = apply_results(batch) if batch.status in ('completed', 'expired', 'cancelled') else (0, 0)
+        # Messages that got no result at all (expired or cancelled batch) become pending again
+        batch_message_ids = [
+            message['_id'] for message in messages_collection.find(
+                {'llm_batch_id': batch.id, 'llm_batch_status': {'$exists': False}},
+                {'_id': 1}
+            )
+        ]
+        unordered_ids = [message_id for message_id in batch_message_ids if not has_orders(message_id)]
+        released = messages_collection.update_many(
+            {'_id': {'$in': unordered_ids}},
+            {'$unset': {'llm_batch_id': ''}}
+        ).modified_count if unordered_ids else 0
+        llm_batches_collection.update_one({'_id': record['_id']}, {'$set': {
+            'status': 'collected',
+            'batch_status': batch.status,
+            'saved_count': saved,
+            'failed_count': failed,
+            'collected_at': datetime.utcnow()
+        }})
+        logger.info(f"Batch {batch.id} ({batch.status}): {saved} messages saved, {failed} failed, {released} released")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backfill order parsing through the OpenAI Batch API.")
+    parser.add_argument('command', choices=['submit', 'collect'])
+    parser.add_argument('--since', type=datetime.fromisoformat, help="Only messages created at or after this date")
+    parser.add_argument('--until', type=datetime.fromisoformat, help="Only messages created before this date")
+    parser.add_argument('--limit', type=int, help="Maximum number of messages to submit")
+    args = parser.parse_args()
+
+    if args.command == 'submit':
+        submit(args.since, args.until, args.limit)
+    else:
+        collect()
@@ -0,0 +1,160 @@
+"""Shared OpenAI client for order parsing.
+
+Order messages are parsed on many threads at once (gunicorn threads and
+webhook_worker.py's pool). Instead of each thread making its own blocking SDK
+call, every request goes through one AsyncOpenAI client running on a dedicated
+event loop thread: its HTTP connection pool is reused across calls, a semaphore
+bounds how many requests are in flight, and every request gets a timeout and
+retries with jittered exponential backoff.
+
+The Batch API helpers at the bottom are for non-urgent backfills (see
+llm_batch.py), where a 24h turnaround is fine and the discount is worth it.
+"""
+import asyncio
+import io
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+import openai
+
+logger = logging.getLogger(__name__)
+
+# Errors worth retrying; anything else (bad request, auth) fails at once
+RETRYABLE_ERRORS = (
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError
+)
+
+
+class LLMBusyError(Exception):
+    """Raised when no concurrency slot frees up before a call's deadline."""
+
+
+class LLMClient:
+    """Thread-safe facade over a shared AsyncOpenAI client with bounded concurrency."""
+
+    def __init__(self, api_key=None, max_concurrency=8, timeout=30, max_retries=3,
+                 backoff_base=0.5, backoff_max=8):
+        self.api_key = api_key
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout  # seconds per request attempt
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._loop = None
+        self._pid = None
+        self._client = None
+        self._semaphore = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        """Start the event loop thread on first use (and again in a forked child)."""
+        with self._lock:
+            if self._loop is not None and self._pid == os.getpid():
+                return self._loop
+
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='llm-client', daemon=True).start()
+            asyncio.run_coroutine_threadsafe(self._setup(), loop).result()
+            self._loop = loop
+            self._pid = os.getpid()
+            return loop
+
+    async def _setup(self):
+        # Created on the loop so the semaphore and HTTP pool belong to it.
+        # Retries are handled here, so the SDK's own are disabled.
+        self._client = openai.AsyncOpenAI(api_key=self.api_key, timeout=self.timeout, max_retries=0)
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    def backoff_delay(self, attempt):
+        """Full-jitter exponential backoff for the given (0-based) retry attempt."""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    async def achat_completion(self, deadline=None, max_retries=None, **kwargs):
+        """Create a chat completion on the client's loop, retrying transient errors.
+
+        With a deadline (seconds), both the wait for a concurrency slot and each
+        request are limited to it. max_retries overrides the client's default.
+        Returns (response, seconds), where seconds is the duration of the
+        successful request alone, without the wait for a slot or backoff.
+        """
+        max_retries = self.max_retries if max_retries is None else max_retries
+        timeout = self.timeout if deadline is None else min(self.timeout, deadline)
+        for attempt in range(max_retries + 1):
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), deadline)
+            except asyncio.TimeoutError:
+                raise LLMBusyError(f'No OpenAI request slot free within {deadline}s')
+            try:
+                start = time.monotonic()
+                response = await self._client.chat.completions.create(timeout=timeout, **kwargs)
+            except RETRYABLE_ERRORS as e:
+                if attempt == max_retries:
+                    raise
+                delay = self.backoff_delay(attempt)
+                logger.warning(f'OpenAI request failed ({type(e).__name__}), retry {attempt + 1} in {delay:.1f}s')
+            else:
+                return response, time.monotonic() - start
+            finally:
+                self._semaphore.release()
+            # Sleep outside the semaphore so other requests can use the slot
+            await asyncio.sleep(delay)
+
+    def chat_completion(self, **kwargs):
+        """Blocking chat completion for callers on ordinary threads; see achat_completion."""
+        loop = self._ensure_started()
+        return asyncio.run_coroutine_threadsafe(self.achat_completion(**kwargs), loop).result()
+
+
+def batch_request_line(custom_id, body):
+    """One line of a Batch API input file for a chat completion request."""
+    return json.dumps({
+        'custom_id': custom_id,
+        'method': 'POST',
+        'url': '/v1/chat/completions',
+        'body': body
+    }, ensure_ascii=False)
+
+
+def submit_batch(api_key, requests, metadata=None):
+    """Upload (custom_id, body) chat completion requests and start a Batch API job."""
+    client = openai.OpenAI(api_key=api_key)
+    content = '\n'.join(batch_request_line(custom_id, body) for custom_id, body in requests)
+    input_file = client.files.create(
+        file=('order_parse_batch.jsonl', io.BytesIO(content.encode('utf-8'))),
+        purpose='batch'
+    )
+    return client.batches.create(
+        input_file_id=input_file.id,
+        endpoint='/v1/chat/completions',
+        completion_window='24h',
+        metadata=metadata
+    )
+
+
+def retrieve_batch(api_key, batch_id):
+    """Return the Batch API job with the given ID."""
+    return openai.OpenAI(api_key=api_key).batches.retrieve(batch_id)
+
+
+def batch_results(api_key, batch):
+    """Yield (custom_id, response body or None, error or None) for a finished batch."""
+    client = openai.OpenAI(api_key=api_key)
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        for line in client.files.content(file_id).text.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            response = record.get('response') or {}
+            if response.get('status_code') == 200:
+                yield record['custom_id'], response.get('body'), None
+            else:
+                yield record['custom_id'], None, record.get('error') or response.get('body')
@@ -0,0 +1,136 @@
+"""Order pipeline events pushed to dashboards over Server-Sent Events.
+
+Events are fanned out per seller (the orders' sender_id) through an in-process
+OrderEventBus. The bus is fed either directly by the app's write paths or, when
+MongoDB runs as a replica set, by a change stream on the orders collection,
+which also sees writes made by other processes such as webhook_worker.py.
+"""
+import logging
+import queue
+import threading
+import time
+
+from image_variants import variant_url
+
+logger = logging.getLogger(__name__)
+
+BROADCAST = None  # seller key for events every subscriber receives
+
+
+class OrderEventBus:
+    """Fan out order events to per-seller subscriber queues."""
+
+    def __init__(self, max_queue_size=100):
+        self.max_queue_size = max_queue_size
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, seller_id):
+        """Register a subscriber for a seller and return its event queue."""
+        subscription = queue.Queue(maxsize=self.max_queue_size)
+        with self._lock:
+            self._subscribers.setdefault(seller_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, seller_id, subscription):
+        """Remove a subscriber queue."""
+        with self._lock:
+            subscribers = self._subscribers.get(seller_id)
+            if subscribers:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[seller_id]
+
+    def publish(self, seller_id, event):
+        """Deliver an event to a seller's subscribers, or to everyone for BROADCAST."""
+        with self._lock:
+            if seller_id is BROADCAST:
+                targets = [s for subscribers in self._subscribers.values() for s in subscribers]
+            else:
+                targets = list(self._subscribers.get(seller_id, ()))
+
+        for subscription in targets:
+            try:
+                subscription.put_nowait(event)
+            except queue.Full:
+                # The client fell behind; tell it to refetch instead of replaying everything
+                with subscription.mutex:
+                    subscription.queue.clear()
+                subscription.put_nowait({'type': 'resync'})
+
+
+def change_to_event(change):
+    """Translate an orders change stream document into (seller_id, event), or None."""
+    order = change.get('fullDocument')
+    if not order:
+        return None
+
+    order_id = str(order['_id'])
+    if change['operationType'] == 'insert':
+        return order.get('sender_id'), {'type': 'created', 'orders': [serialize_order(order)]}
+
+    if change['operationType'] not in ('update', 'replace'):
+        return None
+
+    updated_fields = change.get('updateDescription', {}).get('updatedFields', {})
+    if 'status' in updated_fields:
+        event_type = {
+            'preparing': 'preparing',
+            'billing': 'billing',
+            'completed': 'paid'
+        }.get(updated_fields['status'], 'updated')
+    elif 'price' in updated_fields:
+        event_type = 'price_changed'
+    elif 'image_url' in updated_fields:
+        event_type = 'image_changed'
+    else:
+        event_type = 'updated'
+    return order.get('sender_id'), {'type': event_type, 'orders': [serialize_order(order)], 'order_ids': [order_id]}
+
+
+def watch_order_changes(collection, bus, stop_event=None):
+    """Publish orders change stream events to the bus until stop_event is set."""
+    resume_token = None
+    while not (stop_event and stop_event.is_set()):
+        try:
+            with collection.watch(full_document='updateLookup', resume_after=resume_token) as stream:
+                for change in stream:
+                    resume_token = stream.resume_token
+                    translated = change_to_event(change)
+                    if translated:
+                        bus.publish(*translated)
+                    if stop_event and stop_event.is_set():
+                        break
+        except Exception as e:
+            logger.error(f'Order change stream interrupted: {str(e)}')
+            time.sleep(5)
+
+
+def start_change_stream_watcher(collection, bus):
+    """Start the change stream watcher in a daemon thread."""
+    thread = threading.Thread(
+        target=watch_order_changes,
+        args=(collection, bus),
+        name='order-change-stream',
+        daemon=True
+    )
+    thread.start()
+    return thread
+
+
+def serialize_order(order):
+    """Convert an order document into the JSON shape used by the dashboard endpoints."""
+    return {
+        '_id': str(order['_id']),
+        'customer_name': order.get('customer_name'),
+        'item_name': order.get('item_name'),
+        'color': order.get('color'),
+        'quantity': order.get('quantity', 0),
+        'price': order.get('price', 0),
+        'image_url': variant_url(order.get('image_url', ''), 'thumb'),
+        'status': order.get('status'),
+        'order_group_id': order.get('order_group_id'),
+        'parse_status': order.get('parse_status'),
+        'created_at': order.get('created_at').isoformat() if order.get('created_at') else None,
+        'updated_at': order.get('updated_at').isoformat() if order.get('updated_at') else None
+    }
@@ -0,0 +1,245 @@
+"""Deterministic parser for order messages.
+
+Order messages follow the grammar described in the LLM prompt:
+
+    [product_name] [qty] [color] ... (customer1) [qty] [color] ... (customer2) ...
+
+parse_order_message() understands that grammar locally and returns the same
+structure as the LLM together with a confidence score, so callers only need to
+fall back to OpenAI when the message is ambiguous.
+"""
+import re
+import unicodedata
+
+# Colour vocabulary, lowercase NFC with diacritics. The diacritics matter:
+# "đỏ", "lá" and "bò" are colours but "do", "là" and "bộ" are ordinary words,
+# so stripped forms are only matched for input typed without any (see is_color_word).
+# Modifiers such as "đậm"/"nhạt" are included so "xanh đậm" counts as a colour.
+COLOR_WORDS = {
+    # Vietnamese
+    'đỏ', 'xanh', 'lá', 'dương', 'trời', 'ngọc', 'rêu', 'biển', 'coban', 'vàng',
+    'trắng', 'đen', 'hồng', 'tím', 'than', 'cam', 'nâu', 'xám', 'ghi', 'be',
+    'kem', 'bạc', 'đồng', 'sữa', 'môn', 'mận', 'rượu', 'chanh', 'cafe',
+    'cà', 'phê', 'bò', 'đất', 'phấn', 'ngân', 'cát', 'khói', 'chì', 'oliu',
+    'đậm', 'nhạt', 'sáng', 'tối', 'nhẹ', 'pastel', 'loang', 'sọc', 'kẻ', 'caro',
+    'hoa', 'họa', 'hoạ', 'tiết', 'vân', 'chuột', 'tro', 'da',
+    # English
+    'red', 'blue', 'green', 'black', 'white', 'yellow', 'pink', 'purple',
+    'orange', 'brown', 'grey', 'gray', 'beige', 'cream', 'navy', 'silver',
+    'gold', 'violet', 'mint', 'nude', 'olive', 'khaki', 'wine', 'light', 'dark',
+}
+
+# Words that may prefix a colour ("mau do" = "colour red") without changing it
+COLOR_PREFIXES = {'mau'}
+
+MAX_REASONABLE_QUANTITY = 100
+
+# Confidence factor when several product/quantity splits score equally well
+AMBIGUOUS_SPLIT_PENALTY = 0.5
+
+_TOKEN_RE = re.compile(r'\(|\)|[^\s()]+')
+_QTY_COLOR_RE = re.compile(r'^(\d+)(\D+)$')
+
+
+def normalize_word(word):
+    """Lowercase a word and strip Vietnamese diacritics."""
+    word = word.lower().replace('đ', 'd')
+    decomposed = unicodedata.normalize('NFD', word)
+    return ''.join(ch for ch in decomposed if unicodedata.category(ch) != 'Mn')
+
+
+# Stripped forms, for messages typed without diacritics ("do" for "đỏ")
+_ASCII_COLOR_WORDS = {normalize_word(word) for word in COLOR_WORDS}
+
+
+def is_color_word(word):
+    """Return True if a word is a colour, matching stripped forms only for ASCII input."""
+    word = unicodedata.normalize('NFC', word.lower())
+    if word in COLOR_WORDS:
+        return True
+    return word.isascii() and word in _ASCII_COLOR_WORDS
+
+
+def tokenize(text):
+    """Split a message into words, quantities and parenthesised customer names.
+
+    Returns a list of (kind, value) tuples where kind is 'word', 'qty' or
+    'customer', or None if the parentheses are unbalanced.
+    """
+    tokens = []
+    raw_tokens = _TOKEN_RE.findall(unicodedata.normalize('NFC', text))
+    i = 0
+    while i < len(raw_tokens):
+        raw = raw_tokens[i]
+        if raw == '(':
+            try:
+                end = raw_tokens.index(')', i + 1)
+            except ValueError:
+                return None
+            inner = raw_tokens[i + 1:end]
+            if '(' in inner or not inner:
+                return None
+            tokens.append(('customer', ' '.join(inner)))
+            i = end + 1
+            continue
+        if raw == ')':
+            return None
+
+        if raw.isdigit():
+            tokens.append(('qty', int(raw)))
+        else:
+            # Quantity glued to the colour, e.g. "2đỏ"
+            match = _QTY_COLOR_RE.match(raw)
+            if match:
+                tokens.append(('qty', int(match.group(1))))
+                tokens.append(('word', match.group(2)))
+            else:
+                tokens.append(('word', raw))
+        i += 1
+    return tokens
+
+
+def is_known_color(color_words):
+    """Return True if every word of a colour phrase is in the colour vocabulary."""
+    return bool(color_words) and all(is_color_word(word) for word in color_words)
+
+
+def _parse_orders(tokens):
+    """Parse the customer groups that follow the product name.
+
+    Returns (orders, known_colors, total_items, penalty) or None if the tokens
+    do not follow the grammar.
+    """
+    orders = []
+    customer_index = {}
+    pending_items = []
+    known_colors = 0
+    total_items = 0
+    penalty = 1.0
+    i = 0
+
+    while i < len(tokens):
+        kind, value = tokens[i]
+        if kind == 'customer':
+            if not pending_items:
+                return None
+            if value in customer_index:
+                orders[customer_index[value]]['items'].extend(pending_items)
+            else:
+                customer_index[value] = len(orders)
+                orders.append({'customer_name': value, 'items': pending_items})
+            pending_items = []
+            i += 1
+            continue
+
+        if kind != 'qty':
+            return None
+
+        quantity = value
+        color_words = []
+        i += 1
+        while i < len(tokens) and tokens[i][0] == 'word':
+            color_words.append(tokens[i][1])
+            i += 1
+
+        # Drop a leading "màu" so "2 màu đỏ" reads as colour "đỏ"
+        if len(color_words) > 1 and normalize_word(color_words[0]) in COLOR_PREFIXES:
+            color_words = color_words[1:]
+
+        if not color_words:
+            penalty *= 0.5
+        elif is_known_color(color_words):
+            known_colors += 1
+        if quantity <= 0 or quantity > MAX_REASONABLE_QUANTITY:
+            penalty *= 0.5
+
+        pending_items.append({
+            'color': ' '.join(color_words) if color_words else None,
+            'quantity': quantity
+        })
+        total_items += 1
+
+    # Every item must be attributed to a customer
+    if pending_items or not orders:
+        return None
+
+    return orders, known_colors, total_items, penalty
+
+
+def parse_order_message(text):
+    """Parse an order message without calling the LLM.
+
+    Returns (structured_order, confidence). structured_order has the same shape
+    as the LLM output ({product_name, orders: [{customer_name, items}]}) and is
+    None when the message does not follow the grammar. confidence is between
+    0 and 1; anything below the caller's threshold should go to the LLM.
+    """
+    tokens = tokenize(text or '')
+    if not tokens or tokens[0][0] != 'word':
+        return None, 0.0
+
+    # The product name may itself contain numbers ("Áo 2 dây"), so try every
+    # quantity before the first customer as the end of the product name.
+    first_customer = next(
+        (i for i, (kind, _) in enumerate(tokens) if kind == 'customer'),
+        len(tokens)
+    )
+    candidates = []
+    for split in range(1, first_customer):
+        if tokens[split][0] != 'qty':
+            continue
+        parsed = _parse_orders(tokens[split:])
+        if not parsed:
+            continue
+        orders, known_colors, total_items, penalty = parsed
+        confidence = (known_colors / total_items) * penalty
+        product_name = ' '.join(str(value) for _, value in tokens[:split])
+        candidates.append((confidence, known_colors, product_name, orders))
+
+    if not candidates:
+        return None, 0.0
+
+    # Highest confidence wins, then the split that explains more items with known
+    # colours (a later split that swallows "1 đỏ" into the name is worse). Splits
+    # that still tie mean the product name boundary is a guess, so keep the
+    # shortest name but leave it to the LLM.
+    candidates.sort(key=lambda candidate: candidate[:2], reverse=True)
+    confidence, known_colors, product_name, orders = candidates[0]
+    if len(candidates) > 1 and candidates[1][:2] == (confidence, known_colors):
+        confidence *= AMBIGUOUS_SPLIT_PENALTY
+
+    return {'product_name': product_name, 'orders': orders}, round(confidence, 3)
+
+
+def structured_order_from_lines(order_lines):
+    """Rebuild the structured order of a message from the order documents created from it."""
+    if not order_lines:
+        return None
+    customers = {}
+    for order in order_lines:
+        customers.setdefault(order.get('customer_name'), []).append({
+            'color': order.get('color'),
+            'quantity': order.get('quantity', 1)
+        })
+    return {
+        'product_name': order_lines[0].get('item_name'),
+        'orders': [
+            {'customer_name': name, 'items': items}
+            for name, items in customers.items()
+        ]
+    }
+
+
+def canonical(structured_order):
+    """Reduce a parse result to a comparable form, ignoring case and ordering."""
+    def text(value):
+        return ' '.join(str(value or '').lower().split())
+
+    orders = []
+    for order in structured_order.get('orders', []):
+        items = sorted(
+            (text(item.get('color')), int(item.get('quantity') or 1))
+            for item in order.get('items', [])
+        )
+        orders.append((text(order.get('customer_name')), tuple(items)))
+    return text(structured_order.get('product_name')), tuple(sorted(orders))
@@ -0,0 +1,52 @@
+import argparse
+import logging
+import sys
+
+from app import order_summaries_collection, order_summary_pipeline, orders_collection, rebuild_order_summaries
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+def summary_key(row):
+    return (row.get('sender_id'), row.get('product_name'), row.get('color'))
+
+def check_order_summaries():
+    """Compare the order_summaries view with a fresh aggregation; return the mismatches."""
+    expected = {
+        summary_key(row): row['quantity']
+        for row in orders_collection.aggregate(order_summary_pipeline())
+    }
+    actual = {
+        summary_key(row): row['quantity']
+        for row in order_summaries_collection.find({'quantity': {'$gt': 0}})
+    }
+
+    mismatches = []
+    for key in sorted(set(expected) | set(actual), key=str):
+        if expected.get(key, 0) != actual.get(key, 0):
+            mismatches.append((key, expected.get(key, 0), actual.get(key, 0)))
+    return mismatches
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Rebuild or check the order_summaries view. Pause order writes while rebuilding."
+    )
+    parser.add_argument('--check', action='store_true', help="Only report differences, do not rebuild")
+    args = parser.parse_args()
+
+    if args.check:
+        mismatches = check_order_summaries()
+        for (sender_id, product_name, color), expected, actual in mismatches:
+            logger.error(f"{sender_id} / {product_name} / {color}: expected {expected}, view has {actual}")
+        if mismatches:
+            logger.error(f"{len(mismatches)} order summary rows are out of date")
+            sys.exit(1)
+        logger.info("Order summaries are consistent with orders")
+    else:
+        logger.info("Rebuilding order summaries...")
+        count = rebuild_order_summaries()
+        logger.info(f"Rebuilt order summaries with {count} rows")
@@ -0,0 +1,181 @@
+import argparse
+import json
+import logging
+import os
+import sys
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from bson import ObjectId
+
+from app import (
+    ORDER_PARSER_MIN_CONFIDENCE,
+    messages_collection,
+    orders_collection,
+    parse_order_with_cache,
+    replace_message_orders
+)
+from order_parser import canonical, parse_order_message, structured_order_from_lines
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# Messages read from MongoDB and parsed in parallel before the checkpoint advances
+CHUNK_SIZE = 200
+
+def message_query(since=None, until=None, sender_id=None, after_id=None):
+    """Stored text messages matching the date range and sender, after the checkpoint."""
+    query = {'message': {'$exists': True, '$ne': ''}}
+    if sender_id:
+        query['sender_id'] = sender_id
+    if since or until:
+        query['created_at'] = {}
+        if since:
+            query['created_at']['$gte'] = since
+        if until:
+            query['created_at']['$lt'] = until
+    if after_id:
+        query['_id'] = {'$gt': after_id}
+    return query
+
+def iter_chunks(query):
+    """Stream matching order messages in _id order, CHUNK_SIZE at a time."""
+    cursor = messages_collection.find(
+        query,
+        {'message': 1, 'sender_id': 1, 'parse_status': 1}
+    ).sort('_id', 1).batch_size(CHUNK_SIZE)
+
+    chunk = []
+    for message in cursor:
+        words = message['message'].split()
+        # Same rule as handle_text_message: shorter messages are customer names, not orders
+        if len(words) < 4 or message['message'].lower().startswith('create user'):
+            continue
+        chunk.append(message)
+        if len(chunk) >= CHUNK_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def reparse(message, replace, use_llm):
+    """Parse a message again and compare with (or replace) its orders. Returns (outcome, detail)."""
+    structured_order, confidence = parse_order_message(message['message'])
+    parsed_by = 'local'
+    if not (structured_order and confidence >= ORDER_PARSER_MIN_CONFIDENCE):
+        if not use_llm:
+            return 'unparsed', None
+        structured_order = parse_order_with_cache(message['message'])
+        parsed_by = 'llm'
+
+    existing = structured_order_from_lines(list(
+        orders_collection.find(
+            {'message_id': message['_id']},
+            {'item_name': 1, 'customer_name': 1, 'color': 1, 'quantity': 1}
+        ).sort('_id', 1)
+    ))
+    if not existing and not any(order.get('items') for order in structured_order.get('orders', [])):
+        return 'unchanged', None
+    # Provisional parse_pending orders always get replaced, even if the guess was right
+    if existing and canonical(existing) == canonical(structured_order) and message.get('parse_status') != 'pending':
+        return 'unchanged', None
+    if not replace:
+        return 'changed', (existing, structured_order)
+
+    outcome = replace_message_orders(message, structured_order, parsed_by)
+    if outcome == 'replaced' and message.get('parse_status'):
+        messages_collection.update_one(
+            {'_id': message['_id']},
+            {'$unset': {'parse_status': '', 'parse_pending_at': ''}}
+        )
+    return outcome, None
+
+def load_checkpoint(path, run_key):
+    """Return (last processed message ID, counts) saved for this run, or (None, empty counts)."""
+    if not os.path.exists(path):
+        return None, Counter()
+    with open(path, encoding='utf-8') as f:
+        checkpoint = json.load(f)
+    if checkpoint['run'] != run_key:
+        raise ValueError(f"Checkpoint {path} belongs to a different run: {checkpoint['run']}")
+    return ObjectId(checkpoint['last_id']), Counter(checkpoint['counts'])
+
+def save_checkpoint(path, run_key, last_id, counts):
+    """Atomically record progress so an interrupted run can resume after last_id."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({
+            'run': run_key,
+            'last_id': str(last_id),
+            'counts': counts,
+            'updated_at': datetime.utcnow().isoformat()
+        }, f)
+    os.replace(tmp_path, path)
+
+def reprocess_messages(args):
+    """Re-parse every matching message; returns the outcome counts."""
+    run_key = {
+        'since': args.since.isoformat() if args.since else None,
+        'until': args.until.isoformat() if args.until else None,
+        'sender_id': args.sender_id,
+        'replace': args.replace,
+        'use_llm': not args.no_llm
+    }
+    after_id, counts = load_checkpoint(args.checkpoint, run_key) if args.resume else (None, Counter())
+    if after_id:
+        logger.info(f"Resuming after message {after_id}")
+
+    query = message_query(args.since, args.until, args.sender_id, after_id)
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for chunk in iter_chunks(query):
+            futures = [
+                (message, executor.submit(reparse, message, args.replace, not args.no_llm))
+                for message in chunk
+            ]
+
+            errors = 0
+            for message, future in futures:
+                try:
+                    outcome, detail = future.result()
+                except Exception as e:
+                    logger.error(f"Message {message['_id']}: {type(e).__name__}: {str(e)}")
+                    errors += 1
+                    continue
+                counts[outcome] += 1
+                if outcome == 'changed':
+                    existing, parsed = detail
+                    logger.info(f"Message {message['_id']} {message['message']!r}\n  stored: {existing}\n  parsed: {parsed}")
+                elif outcome == 'conflict':
+                    logger.warning(f"Message {message['_id']}: orders already moved past pickup, left unchanged")
+
+            if errors:
+                # Replacing is idempotent, so resuming re-runs this whole chunk safely
+                counts['error'] += errors
+                logger.error(f"{errors} messages failed; stopping. Fix the cause and rerun with --resume")
+                break
+
+            save_checkpoint(args.checkpoint, run_key, chunk[-1]['_id'], counts)
+            logger.info(f"Checkpoint at message {chunk[-1]['_id']}: {dict(counts)}")
+    return counts
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-parse stored messages and diff or replace their orders.")
+    parser.add_argument('--since', type=datetime.fromisoformat, help="Only messages created at or after this date")
+    parser.add_argument('--until', type=datetime.fromisoformat, help="Only messages created before this date")
+    parser.add_argument('--sender-id', help="Only messages from this sender")
+    parser.add_argument('--replace', action='store_true', help="Replace orders that differ (default: only report them)")
+    parser.add_argument('--no-llm', action='store_true', help="Use only the local parser")
+    parser.add_argument('--workers', type=int, default=8, help="Messages parsed in parallel")
+    parser.add_argument('--checkpoint', default='reprocess_checkpoint.json', help="Progress file")
+    parser.add_argument('--resume', action='store_true', help="Continue after the last checkpoint of the same run")
+    args = parser.parse_args()
+
+    counts = reprocess_messages(args)
+    logger.info(f"Reprocessing finished: {dict(counts)}")
+    if counts.get('error'):
+        sys.exit(1)
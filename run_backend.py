@@ -0,0 +1,71 @@
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# Supervisor configuration
+WORKER_RESTART_DELAY = 5  # seconds before a crashed webhook_worker.py is started again
+SHUTDOWN_TIMEOUT = 30  # seconds the children get to exit after SIGTERM before they are killed
+
+def start_gunicorn():
+    """Start the API server on $PORT."""
+    port = os.getenv('PORT', '5000')
+    return subprocess.Popen(['gunicorn', '--bind', f'0.0.0.0:{port}', '--threads', '16', 'app:app'])
+
+def start_worker():
+    """Start the webhook queue worker."""
+    logger.info("Starting webhook_worker.py")
+    return subprocess.Popen([sys.executable, 'webhook_worker.py'])
+
+def stop_processes(processes):
+    """Send SIGTERM to every running child and wait for them, killing any that hang."""
+    for process in processes:
+        if process.poll() is None:
+            process.send_signal(signal.SIGTERM)
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+    for process in processes:
+        try:
+            process.wait(timeout=max(0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            logger.error(f"Process {process.pid} did not exit after SIGTERM, killing it")
+            process.kill()
+            process.wait()
+
+def main():
+    """Run gunicorn and webhook_worker.py side by side, restarting the worker when it dies.
+
+    Exits when gunicorn exits or on SIGTERM/SIGINT, which are forwarded to both children.
+    """
+    stop_requested = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_requested.append(signum))
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_requested.append(signum))
+
+    gunicorn = start_gunicorn()
+    worker = start_worker()
+    while not stop_requested:
+        if gunicorn.poll() is not None:
+            logger.error(f"gunicorn exited with code {gunicorn.returncode}, shutting down")
+            break
+        if worker.poll() is not None:
+            logger.error(f"webhook_worker.py exited with code {worker.returncode}, "
+                         f"restarting in {WORKER_RESTART_DELAY}s")
+            time.sleep(WORKER_RESTART_DELAY)
+            if stop_requested:
+                break
+            worker = start_worker()
+        time.sleep(1)
+
+    stop_processes([worker, gunicorn])
+    return gunicorn.returncode or 0
+
+if __name__ == '__main__':
+    sys.exit(main())
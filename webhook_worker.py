@@ -0,0 +1,207 @@
+import logging
+import os
+import random
+import signal
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument
+
+from app import (
+    MessageInProgress,
+    app,
+    handle_messaging_event,
+    mirror_pending_order_images,
+    propagate_pending_product_changes,
+    start_pending_parse_reprocessor,
+    webhook_queue_collection,
+    webhook_dead_letter_collection,
+    worker_heartbeats_collection
+)
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# Queue configuration
+WORKER_COUNT = int(os.getenv('WEBHOOK_WORKERS', 4))
+VISIBILITY_TIMEOUT = int(os.getenv('WEBHOOK_VISIBILITY_TIMEOUT', 120))  # seconds
+MAX_ATTEMPTS = int(os.getenv('WEBHOOK_MAX_ATTEMPTS', 5))
+POLL_INTERVAL = float(os.getenv('WEBHOOK_POLL_INTERVAL', 1.0))  # seconds
+SWEEP_INTERVAL = 60  # seconds between retries of unmirrored images and unpropagated product changes
+HEARTBEAT_INTERVAL = 15  # seconds between liveness records read by /api/health
+
+def claim_job():
+    """Lease the next available job, or reclaim one whose lease has expired.
+
+    Each claim gets a fresh lease_id; only the holder of the current lease may
+    renew, complete or fail the job.
+    """
+    now = datetime.utcnow()
+    return webhook_queue_collection.find_one_and_update(
+        {
+            'status': {'$in': ['pending', 'processing']},
+            'available_at': {'$lte': now}
+        },
+        {
+            '$set': {
+                'status': 'processing',
+                'lease_id': uuid.uuid4().hex,
+                'available_at': now + timedelta(seconds=VISIBILITY_TIMEOUT),
+                'updated_at': now
+            },
+            '$inc': {'attempts': 1}
+        },
+        sort=[('available_at', 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+def lease_filter(job):
+    """Match the job only while this worker still holds its lease."""
+    return {'_id': job['_id'], 'lease_id': job['lease_id']}
+
+def renew_lease(job, done):
+    """Keep extending the job's lease until done is set or the lease is lost."""
+    while not done.wait(VISIBILITY_TIMEOUT / 3):
+        result = webhook_queue_collection.update_one(
+            lease_filter(job),
+            {'$set': {'available_at': datetime.utcnow() + timedelta(seconds=VISIBILITY_TIMEOUT)}}
+        )
+        if not result.matched_count:
+            logger.warning(f"Lost the lease on job {job['_id']}")
+            return
+
+def complete_job(job):
+    """Remove a successfully processed job from the queue."""
+    if not webhook_queue_collection.delete_one(lease_filter(job)).deleted_count:
+        logger.warning(f"Job {job['_id']} was re-leased before it completed; leaving it to the new holder")
+
+def fail_job(job, error):
+    """Schedule a failed job for retry, or dead-letter it once out of attempts."""
+    now = datetime.utcnow()
+    if job['attempts'] >= MAX_ATTEMPTS:
+        if not webhook_queue_collection.find_one_and_delete(lease_filter(job)):
+            logger.warning(f"Job {job['_id']} was re-leased before it failed; leaving it to the new holder")
+            return
+        dead_letter = dict(job)
+        dead_letter.update({
+            'status': 'dead',
+            'last_error': str(error),
+            'dead_lettered_at': now
+        })
+        webhook_dead_letter_collection.replace_one({'_id': job['_id']}, dead_letter, upsert=True)
+        logger.error(f"Job {job['_id']} moved to dead letters after {job['attempts']} attempts")
+        return
+
+    # Exponential backoff with jitter before the job becomes visible again
+    delay = min(2 ** job['attempts'], 300) + random.uniform(0, 1)
+    result = webhook_queue_collection.update_one(
+        lease_filter(job),
+        {'$set': {
+            'status': 'pending',
+            'available_at': now + timedelta(seconds=delay),
+            'last_error': str(error),
+            'updated_at': now
+        }}
+    )
+    if not result.matched_count:
+        logger.warning(f"Job {job['_id']} was re-leased before it failed; leaving it to the new holder")
+        return
+    logger.warning(f"Job {job['_id']} failed (attempt {job['attempts']}), retrying in {delay:.1f}s")
+
+def postpone_job(job, until):
+    """Hide a job until another attempt's lease on its message runs out, without spending an attempt."""
+    now = datetime.utcnow()
+    result = webhook_queue_collection.update_one(
+        lease_filter(job),
+        {
+            '$set': {'status': 'pending', 'available_at': max(until, now), 'updated_at': now},
+            '$inc': {'attempts': -1}
+        }
+    )
+    if result.matched_count:
+        logger.info(f"Job {job['_id']}: message is held by another attempt, postponed until {until}")
+
+def process_job(job):
+    """Run a queued messaging event through the regular webhook handling."""
+    # A slow parse must not let the lease expire and hand the job to another worker
+    done = threading.Event()
+    threading.Thread(target=renew_lease, args=(job, done), daemon=True).start()
+    try:
+        with app.app_context():
+            handle_messaging_event(job['event'], from_queue=True)
+        complete_job(job)
+    except MessageInProgress as e:
+        postpone_job(job, e.processing_until)
+    except Exception as e:
+        fail_job(job, e)
+    finally:
+        done.set()
+
+def worker_loop(stop_event):
+    """Drain the queue until asked to stop."""
+    while not stop_event.is_set():
+        try:
+            job = claim_job()
+        except Exception as e:
+            logger.error(f"Error claiming job: {str(e)}")
+            stop_event.wait(POLL_INTERVAL)
+            continue
+
+        if not job:
+            stop_event.wait(POLL_INTERVAL)
+            continue
+
+        process_job(job)
+
+def record_heartbeat(worker_id, worker_count):
+    """Record that this worker process is alive."""
+    worker_heartbeats_collection.update_one(
+        {'_id': worker_id},
+        {'$set': {'seen_at': datetime.utcnow(), 'worker_count': worker_count}},
+        upsert=True
+    )
+
+def run_workers(worker_count=WORKER_COUNT):
+    """Start a pool of queue workers and block until interrupted."""
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    logger.info(f"Starting {worker_count} webhook workers")
+    # Also picks up parse_pending messages left behind by processes that exited
+    start_pending_parse_reprocessor()
+
+    with ThreadPoolExecutor(max_workers=worker_count) as executor:
+        for _ in range(worker_count):
+            executor.submit(worker_loop, stop_event)
+        worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        try:
+            next_sweep = time.monotonic()
+            next_heartbeat = time.monotonic()
+            while not stop_event.is_set():
+                if time.monotonic() >= next_heartbeat:
+                    try:
+                        record_heartbeat(worker_id, worker_count)
+                    except Exception as e:
+                        logger.error(f"Error recording heartbeat: {str(e)}")
+                    next_heartbeat = time.monotonic() + HEARTBEAT_INTERVAL
+                if time.monotonic() >= next_sweep:
+                    try:
+                        mirror_pending_order_images()
+                        propagate_pending_product_changes()
+                    except Exception as e:
+                        logger.error(f"Error in background sweep: {str(e)}")
+                    next_sweep = time.monotonic() + SWEEP_INTERVAL
+                time.sleep(1)
+        except KeyboardInterrupt:
+            stop_event.set()
+        logger.info("Stopping webhook workers...")
+
+if __name__ == "__main__":
+    run_workers()